@@ -0,0 +1,146 @@
+import os
+import pickle
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+import corpus
+import utils
+from comparison import pitch_class_track_features
+from song import AnalyzedSong
+
+# Artist level profiles: for every artist and meter, the sum of its songs' pitch class transition features
+# (see comparison.pitch_class_track_features) and the song count. Profiles are updated one song at a time,
+# and the artist x artist similarity is one matrix product over the profiles. With unnormalized profiles an entry
+# is the mean pitch class similarity over all song pairs of the two artists.
+# Every song's contribution is kept with its pickle's (mtime, size), so re-analyzed songs are replaced and
+# removed (e.g. deduplicated) songs are subtracted, and the profiles stay an incremental view of songPickles.
+
+PROFILE_PATH = os.path.join(utils.OUTPUT_ROOT, "artistProfiles.pickle")
+PROFILE_CHANNELS = 3
+
+
+class ArtistProfiles:
+    sums: Dict[str, Dict[int, np.ndarray]]  # artist -> beats_per_measure -> summed (beats * 144) features
+    counts: Dict[str, Dict[int, int]]  # artist -> beats_per_measure -> song count
+    songs: Dict[str, Set[str]]  # artist -> song ids already added
+    entries: Dict[str, Dict]  # song id -> {"artist", "beats", "features", "stamp"}, the song's contribution
+
+    def __init__(self, max_channels=PROFILE_CHANNELS):
+        self.max_channels = max_channels
+        self.sums = {}
+        self.counts = {}
+        self.songs = {}
+        self.entries = {}
+
+    def add_song(self, song: AnalyzedSong, stamp: Optional[Tuple] = None) -> bool:
+        song_id = song.to_song_id()
+        artist = song.artist
+        if song_id in self.entries:
+            if self.entries[song_id]["stamp"] == stamp:
+                return False
+            self.remove_song(song_id)
+        features = pitch_class_track_features(song, self.max_channels).sum(axis=0)
+        beats = song.beats_per_measure
+        artist_sums = self.sums.setdefault(artist, {})
+        if beats not in artist_sums:
+            artist_sums[beats] = np.zeros_like(features)
+        artist_sums[beats] += features
+        artist_counts = self.counts.setdefault(artist, {})
+        artist_counts[beats] = artist_counts.get(beats, 0) + 1
+        self.songs.setdefault(artist, set()).add(song_id)
+        self.entries[song_id] = {"artist": artist, "beats": beats, "features": features, "stamp": stamp}
+        return True
+
+    def remove_song(self, song_id: str) -> str:
+        # Subtract the song's contribution, return its artist
+        entry = self.entries.pop(song_id)
+        artist, beats = entry["artist"], entry["beats"]
+        self.counts[artist][beats] -= 1
+        if self.counts[artist][beats] == 0:
+            del self.counts[artist][beats], self.sums[artist][beats]
+        else:
+            # Re-sum the remaining songs instead of subtracting, so repeated updates do not accumulate rounding
+            self.sums[artist][beats] = np.sum([self.entries[s]["features"] for s in self.songs[artist]
+                                               if s != song_id and self.entries[s]["beats"] == beats], axis=0)
+        self.songs[artist].discard(song_id)
+        if len(self.songs[artist]) == 0:
+            del self.counts[artist], self.sums[artist], self.songs[artist]
+        return artist
+
+    def update(self, song_ids: List[str]) -> Set[str]:
+        '''
+        Add new songs, replace songs whose pickle changed and remove songs whose pickle is gone,
+        return the artists that changed
+        '''
+        changed = set()
+        for song_id in list(self.entries):
+            if not os.path.exists(utils.to_pickle_path(song_id)):
+                changed.add(self.remove_song(song_id))
+        for song_id in tqdm(song_ids):
+            if song_id.endswith(".pickle"):
+                song_id = song_id[:-len(".pickle")]
+            stat = os.stat(utils.to_pickle_path(song_id))
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if song_id in self.entries and self.entries[song_id]["stamp"] == stamp: continue
+            song = AnalyzedSong(song_id)
+            if self.add_song(song, stamp):
+                changed.add(song.artist)
+        return changed
+
+    def update_from_corpus(self) -> Set[str]:
+        return self.update(corpus.song_ids())
+
+    def save(self, path=PROFILE_PATH):
+        with open(path, "wb") as handle:
+            pickle.dump(self.__dict__, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path=PROFILE_PATH) -> 'ArtistProfiles':
+        profiles = cls()
+        if os.path.exists(path):
+            with open(path, "rb") as handle:
+                state = pickle.load(handle)
+            # Profiles saved without per song entries cannot be updated incrementally, they are rebuilt
+            if "entries" in state:
+                profiles.__dict__.update(state)
+        return profiles
+
+    def song_count(self, artist: str) -> int:
+        return sum(self.counts.get(artist, {}).values())
+
+    def profile_matrix(self, normalize=False) -> Tuple[List[str], np.ndarray]:
+        '''
+        Return (artists, P): one row per artist, meters laid out side by side, divided by the artist's song count
+        (normalize=True scales rows to unit length instead)
+        '''
+        artists = sorted(self.sums.keys())
+        meters = sorted(set(b for sums in self.sums.values() for b in sums))
+        offsets = np.r_[0, np.cumsum([b * 144 for b in meters])]
+        P = np.zeros((len(artists), offsets[-1]), dtype=np.float32)
+        for a, artist in enumerate(artists):
+            for m, beats in enumerate(meters):
+                if beats in self.sums[artist]:
+                    P[a, offsets[m]:offsets[m + 1]] = self.sums[artist][beats]
+            if normalize:
+                norm = np.linalg.norm(P[a])
+                if norm > 0: P[a] /= norm
+            else:
+                P[a] /= self.song_count(artist)
+        return artists, P
+
+    def similarity_matrix(self, normalize=False) -> Tuple[List[str], np.ndarray]:
+        artists, P = self.profile_matrix(normalize)
+        return artists, P @ P.T
+
+
+def main():
+    profiles = ArtistProfiles.load()
+    changed = profiles.update_from_corpus()
+    profiles.save()
+    print(f"Updated {len(changed)} artists, {len(profiles.sums)} total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+import tonnetz
+import utils
+
+# Content addressed analysis cache. A song's analysis is keyed by the hash of its MIDI bytes plus the
+# analysis parameters, so identical files under different names are analyzed once and changing a
+# parameter only invalidates the entries analyzed with the old value. Each MIDI content has one owner song id,
+# the first one analyzed, and keeps it across parameter changes so stored matrices stay indexed by the same ids.
+
+CACHE_INDEX = os.path.join(utils.OUTPUT_ROOT, "analysisCache.json")
+
+
+def analysis_params() -> Dict:
+    # Read at call time so parameters changed at runtime are picked up
+    return {
+        "dist_thresh": tonnetz.DIST_THRESH,
+        "min_transitions": tonnetz.MIN_TRANSITIONS,
+        "intervals": list(tonnetz.DEFAULT_INTERVALS),
+        "lattice": [tonnetz.DEFAULT_X, tonnetz.DEFAULT_Y],
+        "start_note": tonnetz.DEFAULT_START,
+    }
+
+
+def params_hash(params: Optional[Dict] = None) -> str:
+    if params is None:
+        params = analysis_params()
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def midi_hash(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    # songs: song_id -> {"midi", "params", "size", "mtime", "path"}
+    # content: "<midi>-<params>" -> song_id whose pickle holds the analysis
+    # owners: midi -> song_id that holds the analysis of this content, whatever the parameters
+    songs: Dict[str, Dict]
+    content: Dict[str, str]
+    owners: Dict[str, str]
+
+    def __init__(self, index_path=CACHE_INDEX):
+        self.index_path = index_path
+        self.songs = {}
+        self.content = {}
+        self.owners = {}
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            self.songs = index["songs"]
+            self.content = index["content"]
+            self.owners = index.get("owners", {})
+            for key, song_id in self.content.items():
+                self.owners.setdefault(key.split("-")[0], song_id)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"songs": self.songs, "content": self.content, "owners": self.owners}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _midi_hash(self, song_id, midi_path):
+        # Skip rehashing files whose size and modification time did not change
+        stat = os.stat(midi_path)
+        entry = self.songs.get(song_id)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["midi"]
+        return midi_hash(midi_path)
+
+    def key(self, song_id, midi_path, params: Optional[Dict] = None):
+        return f"{self._midi_hash(song_id, midi_path)}-{params_hash(params)}"
+
+    def owner(self, key) -> Optional[str]:
+        # Song id whose pickle holds a valid analysis for this key
+        song_id = self.content.get(key)
+        if song_id is None or not os.path.exists(utils.to_pickle_path(song_id)):
+            return None
+        entry = self.songs.get(song_id)
+        if entry is None or f"{entry['midi']}-{entry['params']}" != key:
+            # The pickle was overwritten by an analysis of other content or parameters
+            return None
+        return song_id
+
+    def record(self, song_id, midi_path, key, owner=None):
+        # Pickles are stored by song id, so re-analyzing (or removing) song_id's pickle invalidates every
+        # key that pointed at it
+        self.content = {k: s for k, s in self.content.items() if s != song_id}
+        stat = os.stat(midi_path)
+        midi, params = key.split("-")
+        self.songs[song_id] = {"midi": midi, "params": params, "size": stat.st_size, "mtime": stat.st_mtime, "path": midi_path}
+        if owner is None:
+            self.content[key] = song_id
+        self.owners[midi] = song_id if owner is None else owner
+
+    def content_owner(self, song_id, midi) -> str:
+        '''
+        Song id that should hold the analysis of this MIDI content: the recorded owner while its file still has
+        this content (and it is either up to date or can be re-analyzed from its path), otherwise song_id
+        '''
+        owner = self.owners.get(midi)
+        if owner is None or owner == song_id or owner not in self.songs:
+            return song_id
+        path = self.songs[owner].get("path")
+        if path is None or not os.path.exists(path):
+            # Indexes written before paths were recorded can only keep an owner that is still valid
+            return owner if path is None and self.songs[owner]["midi"] == midi and self.is_valid(owner) else song_id
+        return owner if self._midi_hash(owner, path) == midi else song_id
+
+    def is_valid(self, song_id, params: Optional[Dict] = None):
+        entry = self.songs.get(song_id)
+        if entry is None or entry["params"] != params_hash(params):
+            return False
+        return self.owner(f"{entry['midi']}-{entry['params']}") is not None
+
+    def stale(self, params: Optional[Dict] = None):
+        # Song ids analyzed with different parameters than the current ones
+        current = params_hash(params)
+        return sorted(s for s, entry in self.songs.items() if entry["params"] != current)
+
+    def duplicates(self):
+        # Song ids that share another song's analysis
+        return sorted(s for s, entry in self.songs.items()
+                      if self.content.get(f"{entry['midi']}-{entry['params']}") not in (None, s))
@@ -0,0 +1,96 @@
+from typing import List, Tuple, Optional
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.cluster.vq import kmeans2
+from scipy.sparse.linalg import eigsh
+
+# Clustering on a sparse k-nearest-neighbour song graph instead of the dense n x n matrix.
+# Memory is O(n * k), so the whole corpus fits on one workstation.
+
+
+def top_k_from_matrix(sim_matrix: np.ndarray, k: int, chunk_size=1024) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Return (indices, scores), both n x k, of the k most similar songs for each row (excluding itself).
+    sim_matrix can be a memmap (e.g. the output of tiling.merge_shards), it is read chunk_size rows at a time.
+    '''
+    n = sim_matrix.shape[0]
+    k = min(k, n - 1)
+    indices = np.zeros((n, k), dtype=np.int64)
+    scores = np.zeros((n, k), dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        rows = np.array(sim_matrix[start:start + chunk_size], dtype=np.float64)
+        row_ids = np.arange(start, start + rows.shape[0])
+        rows[np.arange(rows.shape[0]), row_ids] = -np.inf
+        idx = np.argpartition(rows, -k, axis=1)[:, -k:]
+        indices[row_ids] = idx
+        scores[row_ids] = np.take_along_axis(rows, idx, axis=1)
+    return indices, scores
+
+
+def knn_graph(indices: np.ndarray, scores: np.ndarray, symmetric=True, min_score=0.0) -> sp.csr_matrix:
+    '''
+    Build a sparse weighted adjacency matrix from top-k neighbour lists
+    '''
+    n, k = indices.shape
+    rows = np.repeat(np.arange(n), k)
+    cols = indices.ravel()
+    weights = scores.ravel().astype(np.float64)
+    keep = weights > min_score
+    adj = sp.csr_matrix((weights[keep], (rows[keep], cols[keep])), shape=(n, n))
+    if symmetric:
+        # Keep an edge if either song lists the other, with the larger weight
+        adj = adj.maximum(adj.T).tocsr()
+    adj.setdiag(0)
+    adj.eliminate_zeros()
+    return adj
+
+
+def to_networkx(adj: sp.spmatrix, song_ids: Optional[List[str]] = None) -> nx.Graph:
+    G = nx.from_scipy_sparse_array(adj, edge_attribute="weight")
+    if song_ids is not None:
+        G = nx.relabel_nodes(G, dict(enumerate(song_ids)), copy=False)
+    return G
+
+
+def spectral_clustering(adj: sp.spmatrix, n_clusters: int, seed=0) -> np.ndarray:
+    '''
+    Normalized spectral clustering, return a cluster label per song
+    '''
+    degrees = np.asarray(adj.sum(axis=1)).ravel()
+    inv_sqrt = np.zeros_like(degrees)
+    inv_sqrt[degrees > 0] = 1 / np.sqrt(degrees[degrees > 0])
+    D = sp.diags(inv_sqrt)
+    # Largest eigenvectors of D^-1/2 A D^-1/2 are the smallest of the normalized Laplacian
+    norm_adj = D @ adj @ D
+    _, vecs = eigsh(norm_adj, k=n_clusters, which="LA")
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    _, labels = kmeans2(vecs / norms, n_clusters, minit="++", seed=seed)
+    return labels
+
+
+def louvain_communities(adj: sp.spmatrix, resolution=1.0, seed=0) -> np.ndarray:
+    communities = nx.community.louvain_communities(to_networkx(adj), weight="weight", resolution=resolution, seed=seed)
+    return _communities_to_labels(communities, adj.shape[0])
+
+
+def label_propagation_communities(adj: sp.spmatrix, seed=0) -> np.ndarray:
+    communities = nx.community.asyn_lpa_communities(to_networkx(adj), weight="weight", seed=seed)
+    return _communities_to_labels(communities, adj.shape[0])
+
+
+def _communities_to_labels(communities, n) -> np.ndarray:
+    labels = np.full(n, -1, dtype=np.int64)
+    for label, community in enumerate(communities):
+        labels[list(community)] = label
+    return labels
+
+
+def cluster_members(labels: np.ndarray, song_ids: List[str]) -> List[List[str]]:
+    clusters = [[] for _ in range(labels.max() + 1)]
+    for song_id, label in zip(song_ids, labels):
+        if label >= 0:
+            clusters[label].append(song_id)
+    return sorted(clusters, key=len, reverse=True)
@@ -1,13 +1,15 @@
 from dataclasses import dataclass, field
 
 import utils
-from song import AnalyzedSong
+from song import AnalyzedSong, CompareMethod
 from tonnetz import NoteTransitions
 from typing import List, Optional, Dict, Tuple, Callable
 import numpy as np
+import scipy.sparse as sp
 from tqdm import tqdm
 import concurrent.futures
 import threading
+import os
 
 @dataclass
 class Comparison:
@@ -100,6 +102,254 @@ def simple_compare(song1: AnalyzedSong, song2: AnalyzedSong, max_channels=3, dis
     return comp
 
 
+# Pitch class mode: transitions folded to dense (beats, 12, 12) tensors so comparisons are plain dot products.
+# Weights are scaled by sqrt of the pitch class Tonnetz distance, so a dot product is weighted like
+# edge_list_tonnetz_distance, and summing a song's tracks scores every track pair like simple_compare.
+# Same pitch class transitions are octave jumps (repeated notes are never transitions), weighted as one octave.
+PITCH_CLASS_DIST = np.array([[utils.tonnetz_dist(0, (to_pc - from_pc) % 12 or 12) for to_pc in range(12)]
+                             for from_pc in range(12)], dtype=np.float32)
+
+
+def pitch_class_track_features(song: AnalyzedSong, max_channels=3, octave_direction=False, dist_weighted=True) -> np.ndarray:
+    # (tracks, beats * channels * 144) float32
+    features = []
+    for track in song.tracks[:max_channels]:
+        folded = track.pitch_class_transitions(octave_direction)
+        if dist_weighted:
+            folded = folded * np.sqrt(PITCH_CLASS_DIST)
+        features.append(folded.reshape(-1))
+    if len(features) == 0:
+        return np.zeros((0, song.beats_per_measure * (2 if octave_direction else 1) * 144), dtype=np.float32)
+    return np.stack(features)
+
+
+def pitch_class_compare(song1: AnalyzedSong, song2: AnalyzedSong, max_channels=3, dist_weighted=True, octave_direction=False) -> Optional[Comparison]:
+    if song1.beats_per_measure != song2.beats_per_measure: return None
+    beats = song1.beats_per_measure
+    f1 = pitch_class_track_features(song1, max_channels, octave_direction, dist_weighted).reshape(-1, beats, (2 if octave_direction else 1) * 144)
+    f2 = pitch_class_track_features(song2, max_channels, octave_direction, dist_weighted).reshape(-1, beats, (2 if octave_direction else 1) * 144)
+    # scores[c1, c2, q]
+    scores = np.einsum("aqf,bqf->abq", f1, f2)
+    comp = Comparison(song1, song2)
+    for c1 in range(scores.shape[0]):
+        for c2 in range(scores.shape[1]):
+            for q in range(beats):
+                comp.add_score(q, (c1, c2), float(scores[c1, c2, q]))
+    return comp
+
+
+def pitch_class_feature_matrix(song_ids: List[str], max_channels=3, dist_weighted=True, octave_direction=False):
+    '''
+    Return (features, beats): one contiguous float32 row per song (its tracks summed, padded to the largest meter)
+    and each song's beats_per_measure
+    '''
+    rows = []
+    beats = np.zeros(len(song_ids), dtype=np.int64)
+    for i, song_id in enumerate(tqdm(song_ids)):
+        song = AnalyzedSong(song_id)
+        rows.append(pitch_class_track_features(song, max_channels, octave_direction, dist_weighted).sum(axis=0))
+        beats[i] = song.beats_per_measure
+    width = max((len(r) for r in rows), default=0)
+    features = np.zeros((len(song_ids), width), dtype=np.float32)
+    for i, r in enumerate(rows):
+        features[i, :len(r)] = r
+    return features, beats
+
+
+def pitch_class_similarity_matrix(features: np.ndarray, beats: np.ndarray) -> np.ndarray:
+    # All pairs totals in one matrix multiply, songs in different meters are not compared (like simple_compare)
+    similarity_matrix = features @ features.T
+    similarity_matrix[beats[:, None] != beats[None, :]] = 0
+    return similarity_matrix
+
+
+# Corpus level AnalyzedSong.first_N_tracks_sim_score: one sparse feature matrix per track index (and beat),
+# and the whole song x song score matrix from sparse Gram products.
+# Laplacian cosine uses <L1, L2> = <d1, d2> + 2 * sum over shared edges of w1 * w2 and ||L||^2 = |d|^2 + 2 * |w|^2,
+# so each track becomes [weighted degrees, sqrt(2) * edge weights] and is normalized once.
+
+def _laplacian_features(track, node_index: Dict, edge_index: Dict):
+    # (beat, is_edge, index, value) entries, node columns come before edge columns within each beat
+    entries = []
+    for q, qtrans in enumerate(track.transitions):
+        # Same as building an undirected nx.Graph: a reversed duplicate overwrites the weight
+        weights = {}
+        for (n0, n1), w in qtrans.items():
+            # Self loops (octave jumps on the torus) cancel out of nx.laplacian_matrix
+            if n0 == n1: continue
+            weights[(n1, n0) if (n1, n0) in weights else (n0, n1)] = w
+        degrees = {}
+        for (n0, n1), w in weights.items():
+            degrees[n0] = degrees.get(n0, 0) + w
+            degrees[n1] = degrees.get(n1, 0) + w
+            edge = tuple(sorted((n0, n1)))
+            entries.append((q, True, edge_index.setdefault(edge, len(edge_index)), np.sqrt(2) * w))
+        for node, d in degrees.items():
+            entries.append((q, False, node_index.setdefault(node, len(node_index)), d))
+    return entries
+
+
+def _jaccard_features(track, q, edge_index: Dict):
+    return [edge_index.setdefault(t, len(edge_index)) for t in track.note_number_transitions[q]]
+
+
+def _sparse_rows(rows_cols, rows_vals=None, width=None):
+    indptr = np.r_[0, np.cumsum([len(c) for c in rows_cols])]
+    indices = np.array([c for cols in rows_cols for c in cols], dtype=np.int64)
+    if rows_vals is None:
+        data = np.ones(len(indices))
+    else:
+        data = np.array([v for vals in rows_vals for v in vals], dtype=np.float64)
+    if width is None:
+        width = indices.max() + 1 if len(indices) > 0 else 1
+    mat = sp.csr_matrix((data, indices, indptr), shape=(len(rows_cols), width))
+    mat.sum_duplicates()
+    return mat
+
+
+def first_N_tracks_sim_matrix(songs: List[AnalyzedSong], compare_method: CompareMethod, N: int) -> np.ndarray:
+    '''
+    first_N_tracks_sim_score for every pair of songs. Pairs where a song has fewer than N tracks,
+    or the songs have a different number of beats per measure, are NaN. A beat where neither track has
+    a transition adds 0 to the Jaccard score.
+    '''
+    n = len(songs)
+    scores = np.zeros((n, n))
+    valid = np.array([len(s.tracks) >= N for s in songs])
+    beats = np.array([len(s.tracks[0].note_number_transitions) if len(s.tracks) > 0 else 0 for s in songs])
+    members = np.flatnonzero(valid)
+
+    for i in range(N):
+        if compare_method == CompareMethod.LAP_COSINE_SIM:
+            node_index, edge_index = {}, {}
+            entries = [_laplacian_features(songs[s].tracks[i], node_index, edge_index) for s in members]
+            nodes = len(node_index)
+            width = nodes + len(edge_index)
+            X = _sparse_rows([[q * width + (nodes + k if is_edge else k) for q, is_edge, k, _ in e] for e in entries],
+                             [[v for _, _, _, v in e] for e in entries], width * max(beats[members], default=1))
+            norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+            norms[norms == 0] = 1
+            gram = (X @ X.T).toarray() / np.outer(norms, norms)
+            scores[np.ix_(members, members)] += gram
+        elif compare_method == CompareMethod.EDGES_JACCARD_SIM:
+            for b in np.unique(beats[members]):
+                group = members[beats[members] == b]
+                for q in range(b):
+                    edge_index = {}
+                    X = _sparse_rows([_jaccard_features(songs[s].tracks[i], q, edge_index) for s in group])
+                    sizes = np.asarray(X.sum(axis=1)).ravel()
+                    inter = (X @ X.T).toarray()
+                    union = sizes[:, None] + sizes[None, :] - inter
+                    scores[np.ix_(group, group)] += np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+    scores[~valid, :] = np.nan
+    scores[:, ~valid] = np.nan
+    scores[beats[:, None] != beats[None, :]] = np.nan
+    return scores
+
+
+# Cascaded comparison. Every term of edge_list_tonnetz_distance is ton_dist * (1 - weight_diff) * max_weight
+# <= ton_dist * (w1 + w2), so with U[q, t] = sum over tracks of ton_dist * w and M[q, t] = number of tracks with t,
+# simple_compare(song1, song2) <= U1 . M2 + M1 . U2 (tier 1, a sparse dot product per pair)
+#                                <= sum(U1) * max(M2) + max(M1) * sum(U2) (tier 0, constant time per pair).
+# Pairs whose bound is below the threshold, or below the current top-k cutoff, are never compared exactly.
+
+@dataclass
+class BoundFeatures:
+    U: sp.csr_matrix  # songs x (beat, from, to), distance weighted transition mass over the first max_channels tracks
+    M: sp.csr_matrix  # songs x (beat, from, to), number of tracks containing the transition
+    totals: np.ndarray  # Row sums of U
+    max_counts: np.ndarray  # Row maxima of M
+    beats: np.ndarray
+
+    def tier0(self, i, cols):
+        return self.totals[i] * self.max_counts[cols] + self.max_counts[i] * self.totals[cols]
+
+    def tier1(self, i, cols):
+        return (self.M[cols] @ self.U[i].T + self.U[cols] @ self.M[i].T).toarray().ravel()
+
+
+def bound_features(songs: List[AnalyzedSong], max_channels=3, dist_weighted=True) -> BoundFeatures:
+    u_rows, m_rows = [], []
+    for song in songs:
+        u, m = {}, {}
+        for track in song.tracks[:max_channels]:
+            for q, qtrans in enumerate(track.note_number_transitions):
+                for (from_note, to_note), weight in qtrans.items():
+                    f = (q * 128 + from_note) * 128 + to_note
+                    ton_dist = utils.tonnetz_dist(from_note, to_note) if dist_weighted else 1
+                    u[f] = u.get(f, 0) + ton_dist * weight
+                    m[f] = m.get(f, 0) + 1
+        u_rows.append(u)
+        m_rows.append(m)
+    width = 128 * 128 * max((s.beats_per_measure for s in songs), default=1)
+    U = _sparse_rows([list(u.keys()) for u in u_rows], [list(u.values()) for u in u_rows], width)
+    M = _sparse_rows([list(m.keys()) for m in m_rows], [list(m.values()) for m in m_rows], width)
+    return BoundFeatures(U, M, np.asarray(U.sum(axis=1)).ravel(), M.max(axis=1).toarray().ravel(),
+                         np.array([s.beats_per_measure for s in songs]))
+
+
+def _exact_score(songs, i, j, cache, max_channels, dist_weighted):
+    key = (i, j) if i <= j else (j, i)
+    if key not in cache:
+        comp = simple_compare(songs[i], songs[j], max_channels, dist_weighted)
+        cache[key] = 0 if comp is None else comp.total_score
+    return cache[key]
+
+
+def cascaded_similarity_matrix(songs: List[AnalyzedSong], threshold: float, max_channels=3, dist_weighted=True):
+    '''
+    simple_compare totals for every pair whose upper bound reaches threshold, as a sparse symmetric matrix.
+    Kept entries are exact; every pruned pair has a total below threshold. Also returns how many pairs each tier pruned.
+    '''
+    n = len(songs)
+    bounds = bound_features(songs, max_channels, dist_weighted)
+    cache = {}
+    stats = {"pairs": n * (n + 1) // 2, "meter_pruned": 0, "tier0_pruned": 0, "tier1_pruned": 0, "exact": 0}
+    rows, cols, vals = [], [], []
+    for i in tqdm(range(n)):
+        cand = np.arange(i, n)
+        cand = cand[bounds.beats[cand] == bounds.beats[i]]
+        stats["meter_pruned"] += (n - i) - len(cand)
+        passed = cand[bounds.tier0(i, cand) >= threshold]
+        stats["tier0_pruned"] += len(cand) - len(passed)
+        survivors = passed[bounds.tier1(i, passed) >= threshold]
+        stats["tier1_pruned"] += len(passed) - len(survivors)
+        stats["exact"] += len(survivors)
+        for j in survivors:
+            score = _exact_score(songs, i, j, cache, max_channels, dist_weighted)
+            rows.append(i)
+            cols.append(j)
+            vals.append(score)
+    upper = sp.coo_matrix((vals, (rows, cols)), shape=(n, n)).tocsr()
+    return upper + sp.triu(upper, 1).T.tocsr(), stats
+
+
+def cascaded_top_k(songs: List[AnalyzedSong], k: int, max_channels=3, dist_weighted=True):
+    '''
+    Exact top k simple_compare neighbours of every song (excluding itself) as (indices, scores) lists.
+    Candidates are compared in decreasing tier 1 bound order until the bound drops to the k-th best score.
+    '''
+    n = len(songs)
+    bounds = bound_features(songs, max_channels, dist_weighted)
+    cache = {}
+    indices, scores = [], []
+    for i in tqdm(range(n)):
+        cand = np.flatnonzero(bounds.beats == bounds.beats[i])
+        cand = cand[cand != i]
+        upper = bounds.tier1(i, cand)
+        best = []  # (score, j)
+        for c in np.argsort(upper)[::-1]:
+            if len(best) == k and upper[c] <= best[-1][0]: break
+            j = int(cand[c])
+            best.append((_exact_score(songs, i, j, cache, max_channels, dist_weighted), j))
+            best.sort(key=lambda b: b[0], reverse=True)
+            best = best[:k]
+        indices.append([j for _, j in best])
+        scores.append([score for score, _ in best])
+    return indices, scores
+
+
 def compute_similarity_matrix(song_ids: List[str], similarity_function: Callable[[AnalyzedSong, AnalyzedSong], Optional[Comparison]]):
     n = len(song_ids)
     similarity_matrix = np.zeros((n, n))
@@ -128,6 +378,88 @@ def compute_sim_portion(song_ids: List[str], similarity_function: Callable[[Anal
     return similarity_matrix
 
 
+# Out of core mode: the matrix is walked in blocks of songs, only the current row block and column block
+# are decoded in memory while a thread pool loads the next column block in the background
+PICKLE_EXPANSION = 3  # Rough ratio of in memory AnalyzedSong size to pickle file size
+
+
+def plan_block_size(song_ids: List[str], memory_budget: int, resident_blocks=3):
+    # Row block, column block and the one being prefetched must fit in the budget
+    sizes = [os.path.getsize(utils.to_pickle_path(s)) for s in song_ids]
+    per_song = max(1, int(np.mean(sizes) * PICKLE_EXPANSION)) if len(sizes) > 0 else 1
+    return max(1, min(len(song_ids), memory_budget // (resident_blocks * per_song)))
+
+
+def _block_schedule(block_count):
+    # Columns of each row are visited right to left, so the last column block of row b is row block b + 1
+    schedule = []
+    for bi in range(block_count):
+        for bj in range(block_count - 1, bi, -1):
+            schedule.append((bi, bj))
+        schedule.append((bi, bi))
+    return schedule
+
+
+def compute_sim_blocks(song_ids: List[str], similarity_function: Callable[[AnalyzedSong, AnalyzedSong], Optional[Comparison]],
+                       block_size=None, memory_budget=2**30, prefetch_workers=4, output_path=None):
+    n = len(song_ids)
+    if block_size is None:
+        block_size = plan_block_size(song_ids, memory_budget)
+    block_count = (n + block_size - 1) // block_size
+    bounds = [(b * block_size, min((b + 1) * block_size, n)) for b in range(block_count)]
+
+    if output_path is None:
+        similarity_matrix = np.zeros((n, n))
+    else:
+        similarity_matrix = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float64, shape=(n, n))
+
+    schedule = _block_schedule(block_count)
+    # Blocks in the order they have to be loaded, the diagonal reuses the current row block
+    loads = [bj for bi, bj in schedule if bi != bj]
+    if block_count > 0:
+        loads.insert(0, 0)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_workers) as pool:
+        def submit(b):
+            return [pool.submit(AnalyzedSong, s) for s in song_ids[slice(*bounds[b])]]
+
+        pending = submit(loads[0]) if len(loads) > 0 else None
+        next_load = 1
+
+        def take():
+            # Wait for the prefetched block and start loading the one after it
+            nonlocal pending, next_load
+            block = [f.result() for f in pending]
+            pending = submit(loads[next_load]) if next_load < len(loads) else None
+            next_load += 1
+            return block
+
+        row_block = None
+        col_block = None
+        for bi, bj in tqdm(schedule):
+            if row_block is None:
+                row_block = take()
+            if bi != bj:
+                col_block = None
+                col_block = take()
+            cols = row_block if bi == bj else col_block
+
+            r0, c0 = bounds[bi][0], bounds[bj][0]
+            for r, song1 in enumerate(row_block):
+                for c, song2 in enumerate(cols):
+                    if bi == bj and c < r: continue
+                    comp = similarity_function(song1, song2)
+                    if comp is None: continue
+                    similarity_matrix[r0 + r, c0 + c] = comp.total_score
+                    similarity_matrix[c0 + c, r0 + r] = comp.total_score
+
+            if bi == bj:
+                # Last column block of this row is the next row block
+                row_block = col_block
+                col_block = None
+    return similarity_matrix
+
+
 def concur_compare_and_store(matrix, lock, i, j, song1, song2):
     if i % 100 == 0 and j % 100 == 0:
         print(f"{i}, {j} ({song1}, {song2})")
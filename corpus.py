@@ -0,0 +1,153 @@
+import concurrent.futures
+import os
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from tqdm import tqdm
+
+import utils
+from song import AnalyzedSong
+
+# Streaming access to the analyzed corpus. Songs are loaded one at a time from songPickles and, when fields are
+# given, reduced to just those fields before the next one is loaded, so a pass over the corpus holds one song
+# (or one batch) at a time. map_reduce runs a function over the corpus in worker processes, each worker loads its
+# own songs and only the function's results are sent back, with a bounded number of tasks in flight.
+
+PICKLE_ROOT = os.path.join(utils.OUTPUT_ROOT, "songPickles")
+TRACK_FIELDS = ("transitions", "note_number_transitions", "instrument")
+
+
+def song_ids(root=PICKLE_ROOT) -> List[str]:
+    # Sorted pickle names, the ids every matrix in analysis/ is indexed by
+    return sorted(entry.name for entry in os.scandir(root) if entry.name.endswith(".pickle"))
+
+
+def artists(data_root=utils.DATA_ROOT) -> List[str]:
+    return sorted(entry.name for entry in os.scandir(data_root) if entry.is_dir())
+
+
+def midi_paths(artist_names: Optional[Iterable[str]] = None, data_root=utils.DATA_ROOT, skip_digits=False) -> Iterator[str]:
+    '''
+    Yield artist/song.mid paths under data_root. Duplicates are found by content hash (see cache.AnalysisCache),
+    skip_digits restores the old file name heuristic of utils.for_song_in_artist
+    '''
+    if artist_names is None:
+        artist_names = artists(data_root)
+    for artist in artist_names:
+        for song_name in sorted(os.listdir(os.path.join(data_root, artist))):
+            if skip_digits and any(char.isdigit() for char in song_name): continue
+            yield os.path.join(artist, song_name)
+
+
+def load_fields(song_id: str, fields: Optional[Sequence[str]] = None, max_tracks: Optional[int] = None):
+    '''
+    Return the AnalyzedSong, or with fields a dict of only those attributes. Track fields (TRACK_FIELDS) are
+    lists over the first max_tracks tracks, "song_id" is the pickle name and anything else is a song attribute.
+    '''
+    song = AnalyzedSong(song_id)
+    if fields is None:
+        if max_tracks is not None:
+            song.tracks = song.tracks[:max_tracks]
+        return song
+    record: Dict[str, Any] = {}
+    for field in fields:
+        if field == "song_id":
+            record[field] = song_id
+        elif field in TRACK_FIELDS:
+            record[field] = [getattr(track, field) for track in song.tracks[:max_tracks]]
+        else:
+            record[field] = getattr(song, field)
+    return record
+
+
+def iter_songs(ids: Optional[Sequence[str]] = None, fields: Optional[Sequence[str]] = None, max_tracks: Optional[int] = None,
+               batch_size: Optional[int] = None, tqdm_disable=True) -> Iterator:
+    '''
+    Yield songs (see load_fields) one at a time, or in lists of batch_size
+    '''
+    if ids is None:
+        ids = song_ids()
+    batch = []
+    for song_id in tqdm(ids, disable=tqdm_disable):
+        item = load_fields(song_id, fields, max_tracks)
+        if batch_size is None:
+            yield item
+            continue
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _apply_chunk(fn: Callable, ids: Sequence[str], fields, max_tracks) -> List:
+    # Runs in a worker: load, apply, and drop each song before the next one
+    return [fn(load_fields(song_id, fields, max_tracks)) for song_id in ids]
+
+
+def imap(fn: Callable, ids: Optional[Sequence[str]] = None, fields: Optional[Sequence[str]] = None, max_tracks: Optional[int] = None,
+         workers: Optional[int] = None, max_in_flight: Optional[int] = None, chunk_size=1, ordered=True, tqdm_disable=True) -> Iterator:
+    '''
+    Yield fn(song) for every song. With workers > 1 songs are processed in a process pool (fn must be picklable,
+    i.e. a module level function) with at most max_in_flight chunks queued or running, so memory is bounded by the
+    in flight chunks whatever the corpus size. ordered=False yields results as they complete.
+    '''
+    if ids is None:
+        ids = song_ids()
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    progress = tqdm(total=len(ids), disable=tqdm_disable)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _apply_chunk(fn, chunk, fields, max_tracks)
+            progress.update(len(chunk))
+        progress.close()
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = iter(chunks)
+        in_flight = deque()
+
+        def submit():
+            chunk = next(pending, None)
+            if chunk is not None:
+                in_flight.append(executor.submit(_apply_chunk, fn, chunk, fields, max_tracks))
+
+        for _ in range(max_in_flight):
+            submit()
+        while len(in_flight) > 0:
+            if ordered:
+                done = [in_flight.popleft()]
+            else:
+                finished, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                done = [f for f in in_flight if f in finished]
+                for f in done:
+                    in_flight.remove(f)
+            for future in done:
+                results = future.result()
+                submit()
+                progress.update(len(results))
+                yield from results
+    progress.close()
+
+
+_NO_INITIAL = object()
+
+
+def map_reduce(fn: Callable, reducer: Callable, initial=_NO_INITIAL, ids: Optional[Sequence[str]] = None,
+               fields: Optional[Sequence[str]] = None, max_tracks: Optional[int] = None, workers: Optional[int] = None,
+               max_in_flight: Optional[int] = None, chunk_size=1, ordered=True, tqdm_disable=True):
+    '''
+    Fold fn(song) over the corpus with reducer(accumulated, result), like functools.reduce. Results are reduced
+    as they arrive, so the memory used is that of the accumulator plus the in flight chunks.
+    '''
+    accumulated = initial
+    for result in imap(fn, ids, fields, max_tracks, workers, max_in_flight, chunk_size, ordered, tqdm_disable):
+        accumulated = result if accumulated is _NO_INITIAL else reducer(accumulated, result)
+    if accumulated is _NO_INITIAL:
+        raise ValueError("map_reduce of an empty corpus with no initial value")
+    return accumulated
@@ -0,0 +1,169 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import expm_multiply
+from tqdm import tqdm
+
+import corpus
+import utils
+from comparison import Comparison
+from song import AnalyzedSong
+from tonnetz import Tonnetz, TonnetzQuarterTrack
+
+# Heat kernel similarity. Each track's per beat transition mass (source and target coordinates of its
+# lattice transitions) is diffused over the Tonnetz lattice with exp(-tL), so transitions that are close on the
+# lattice but not identical still overlap. Signatures are computed with sparse expm_multiply actions on the
+# shared lattice Laplacian, many tracks per call, and cached, so a track pair score is a dot product:
+# <exp(-tL) x, exp(-tL) y> = x^T exp(-2tL) y.
+
+DIFFUSION_ROOT = os.path.join(utils.OUTPUT_ROOT, "diffusion")
+DEFAULT_TIME = 1.0
+BATCH_SONGS = 256  # Songs diffused per expm_multiply call
+
+
+class DiffusionLattice:
+    nodes: List
+    node_index: Dict
+    L: sp.csr_matrix
+
+    def __init__(self, tonnetz: Optional[Tonnetz] = None):
+        # Only the finite lattice has a graph to diffuse on, analytic tracks have no fixed node set
+        if tonnetz is None:
+            tonnetz = Tonnetz()
+        self.nodes = list(tonnetz.G.nodes())
+        self.node_index = {n: i for i, n in enumerate(self.nodes)}
+        self.L = nx.laplacian_matrix(tonnetz.G, nodelist=self.nodes).astype(np.float64).tocsr()
+
+    def track_signal(self, track: TonnetzQuarterTrack) -> np.ndarray:
+        # (nodes, beats * 2): column 2q holds beat q's source mass, column 2q + 1 its target mass
+        signal = np.zeros((len(self.nodes), 2 * len(track.transitions)))
+        for q, qtrans in enumerate(track.transitions):
+            for (prevCoord, currCoord), weight in qtrans.items():
+                signal[self.node_index[prevCoord], 2 * q] += weight
+                signal[self.node_index[currCoord], 2 * q + 1] += weight
+        return signal
+
+    def diffuse(self, signals: np.ndarray, t=DEFAULT_TIME) -> np.ndarray:
+        # exp(-tL) applied to every column at once, never forming the dense exponential
+        if signals.shape[1] == 0 or t == 0:
+            return signals
+        return expm_multiply(-t * self.L, signals)
+
+    def track_signatures(self, tracks: List[TonnetzQuarterTrack], t=DEFAULT_TIME) -> List[np.ndarray]:
+        '''
+        Return one flat (beats * 2 * nodes) float32 signature per track
+        '''
+        signals = [self.track_signal(track) for track in tracks]
+        if len(signals) == 0:
+            return []
+        diffused = self.diffuse(np.concatenate(signals, axis=1), t)
+        offsets = np.r_[0, np.cumsum([s.shape[1] for s in signals])]
+        return [diffused[:, offsets[k]:offsets[k + 1]].T.astype(np.float32).reshape(-1) for k in range(len(signals))]
+
+
+def diffusion_compare(song1: AnalyzedSong, song2: AnalyzedSong, max_channels=3, t=DEFAULT_TIME,
+                      lattice: Optional[DiffusionLattice] = None) -> Optional[Comparison]:
+    # Pairwise version with simple_compare's layout, every track pair of the first max_channels tracks per beat
+    if song1.beats_per_measure != song2.beats_per_measure: return None
+    if lattice is None:
+        lattice = DiffusionLattice()
+    beats = song1.beats_per_measure
+    f1 = lattice.track_signatures(song1.tracks[:max_channels], t)
+    f2 = lattice.track_signatures(song2.tracks[:max_channels], t)
+    comp = Comparison(song1, song2)
+    for c1, s1 in enumerate(f1):
+        for c2, s2 in enumerate(f2):
+            scores = (s1.reshape(beats, -1) * s2.reshape(beats, -1)).sum(axis=1)
+            for q in range(beats):
+                comp.add_score(q, (c1, c2), float(scores[q]))
+    return comp
+
+
+class DiffusionIndex:
+    song_ids: List[str]
+    signatures: np.ndarray  # (tracks, max beats * 2 * nodes) float32, padded with zeros for shorter meters
+    offsets: np.ndarray  # Song i owns signatures[offsets[i]:offsets[i + 1]]
+    beats: np.ndarray
+
+    def __init__(self, song_ids: List[str], signatures: np.ndarray, offsets: np.ndarray, beats: np.ndarray, t=DEFAULT_TIME):
+        self.song_ids = song_ids
+        self.signatures = signatures
+        self.offsets = np.asarray(offsets)
+        self.beats = np.asarray(beats)
+        self.t = t
+        self.id_map = {s: i for i, s in enumerate(song_ids)}
+
+    @classmethod
+    def build(cls, song_ids: List[str], max_channels=3, t=DEFAULT_TIME, lattice: Optional[DiffusionLattice] = None,
+              batch_songs=BATCH_SONGS) -> 'DiffusionIndex':
+        if lattice is None:
+            lattice = DiffusionLattice()
+        rows, counts = [], []
+        beats = np.zeros(len(song_ids), dtype=np.int64)
+        for start in tqdm(range(0, len(song_ids), batch_songs)):
+            # One expm_multiply call for every track of the batch
+            tracks = []
+            for i in range(start, min(start + batch_songs, len(song_ids))):
+                song = AnalyzedSong(song_ids[i])
+                beats[i] = song.beats_per_measure
+                counts.append(min(max_channels, len(song.tracks)))
+                tracks.extend(song.tracks[:max_channels])
+            rows.extend(lattice.track_signatures(tracks, t))
+
+        width = max((len(r) for r in rows), default=0)
+        signatures = np.zeros((len(rows), width), dtype=np.float32)
+        for k, r in enumerate(rows):
+            signatures[k, :len(r)] = r
+        return cls(song_ids, signatures, np.r_[0, np.cumsum(counts)], beats, t)
+
+    def save(self, root=DIFFUSION_ROOT):
+        os.makedirs(root, exist_ok=True)
+        np.save(os.path.join(root, "signatures.npy"), self.signatures)
+        np.save(os.path.join(root, "offsets.npy"), self.offsets)
+        np.save(os.path.join(root, "beats.npy"), self.beats)
+        with open(os.path.join(root, "song_ids.json"), "w") as f:
+            json.dump({"song_ids": self.song_ids, "t": self.t}, f)
+
+    @classmethod
+    def load(cls, root=DIFFUSION_ROOT, mmap=False) -> 'DiffusionIndex':
+        with open(os.path.join(root, "song_ids.json"), "r") as f:
+            meta = json.load(f)
+        signatures = np.load(os.path.join(root, "signatures.npy"), mmap_mode="r" if mmap else None)
+        return cls(meta["song_ids"], signatures, np.load(os.path.join(root, "offsets.npy")),
+                   np.load(os.path.join(root, "beats.npy")), meta["t"])
+
+    def track_signatures(self, i: int) -> np.ndarray:
+        return self.signatures[self.offsets[i]:self.offsets[i + 1]]
+
+    def song_vectors(self) -> np.ndarray:
+        # Tracks summed per song, so one dot product scores every track pair
+        counts = np.diff(self.offsets)
+        owner = sp.csr_matrix((np.ones(counts.sum(), dtype=np.float32), (np.repeat(np.arange(len(counts)), counts),
+                               np.arange(counts.sum()))), shape=(len(counts), self.signatures.shape[0]))
+        return np.asarray(owner @ self.signatures)
+
+    def score(self, i: int, j: int) -> Optional[float]:
+        if self.beats[i] != self.beats[j]: return None
+        return float(self.track_signatures(i).sum(axis=0) @ self.track_signatures(j).sum(axis=0))
+
+    def similarity_matrix(self) -> np.ndarray:
+        # Songs in different meters are not compared (like simple_compare)
+        vectors = self.song_vectors()
+        similarity_matrix = vectors @ vectors.T
+        similarity_matrix[self.beats[:, None] != self.beats[None, :]] = 0
+        return similarity_matrix
+
+
+def main():
+    song_ids = corpus.song_ids()
+    index = DiffusionIndex.build(song_ids)
+    index.save()
+    print(f"Diffused {index.signatures.shape[0]} tracks of {len(song_ids)} songs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from scipy.cluster.vq import kmeans2
+from tqdm import tqdm
+
+import utils
+from song import AnalyzedSong
+
+# Fixed length song embeddings, used as a cheap first stage retriever in front of simple_compare.
+# The per beat note_number_transitions of the first max_channels tracks are summed (simple_compare scores every
+# track pair, so the sum keeps that cross track behaviour) and projected to EMBEDDING_DIM with a signed feature hash.
+# Weights are scaled by sqrt(tonnetz_dist) so dot products are weighted like edge_list_tonnetz_distance.
+
+EMBEDDING_DIM = 256
+EMBEDDING_ROOT = os.path.join(utils.OUTPUT_ROOT, "embeddings")
+MIDI_NOTES = 128
+_HASH_MULT = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _hash_features(features: np.ndarray, dim: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Bucket and sign of each flat feature index
+    h = (features.astype(np.uint64) + np.uint64(seed)) * _HASH_MULT
+    h ^= h >> np.uint64(29)
+    buckets = (h % np.uint64(dim)).astype(np.int64)
+    signs = np.where((h >> np.uint64(63)) == 1, -1.0, 1.0)
+    return buckets, signs
+
+
+def song_embedding(song: AnalyzedSong, max_channels=3, dim=EMBEDDING_DIM, seed=0, normalize=True) -> np.ndarray:
+    features, values = [], []
+    for track in song.tracks[:max_channels]:
+        for q, qtrans in enumerate(track.note_number_transitions):
+            for (from_note, to_note), weight in qtrans.items():
+                features.append((q * MIDI_NOTES + from_note) * MIDI_NOTES + to_note)
+                values.append(weight * np.sqrt(utils.tonnetz_dist(from_note, to_note)))
+
+    embedding = np.zeros(dim, dtype=np.float32)
+    if len(features) == 0:
+        return embedding
+    buckets, signs = _hash_features(np.array(features), dim, seed)
+    embedding += np.bincount(buckets, weights=signs * np.array(values), minlength=dim).astype(np.float32)
+    if normalize:
+        norm = np.linalg.norm(embedding)
+        if norm > 0: embedding /= norm
+    return embedding
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    # Indices of the k largest scores of each row, best first
+    k = min(k, scores.shape[-1])
+    idx = np.argpartition(scores, -k, axis=-1)[..., -k:]
+    order = np.argsort(np.take_along_axis(scores, idx, axis=-1), axis=-1)[..., ::-1]
+    return np.take_along_axis(idx, order, axis=-1)
+
+
+class EmbeddingIndex:
+    song_ids: List[str]
+    vectors: np.ndarray  # n x dim float32
+    beats: np.ndarray  # beats_per_measure of each song, songs only match songs with the same meter
+
+    def __init__(self, song_ids: List[str], vectors: np.ndarray, beats: np.ndarray):
+        self.song_ids = song_ids
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.beats = np.asarray(beats)
+        self.id_map = {s: i for i, s in enumerate(song_ids)}
+
+    @classmethod
+    def build(cls, song_ids: List[str], max_channels=3, dim=EMBEDDING_DIM, seed=0) -> 'EmbeddingIndex':
+        vectors = np.zeros((len(song_ids), dim), dtype=np.float32)
+        beats = np.zeros(len(song_ids), dtype=np.int64)
+        for i, song_id in enumerate(tqdm(song_ids)):
+            song = AnalyzedSong(song_id)
+            vectors[i] = song_embedding(song, max_channels, dim, seed)
+            beats[i] = song.beats_per_measure
+        return cls(song_ids, vectors, beats)
+
+    def save(self, root=EMBEDDING_ROOT):
+        os.makedirs(root, exist_ok=True)
+        np.save(os.path.join(root, "vectors.npy"), self.vectors)
+        np.save(os.path.join(root, "beats.npy"), self.beats)
+        with open(os.path.join(root, "song_ids.json"), "w") as f:
+            json.dump(self.song_ids, f)
+
+    @classmethod
+    def load(cls, root=EMBEDDING_ROOT, mmap=False) -> 'EmbeddingIndex':
+        with open(os.path.join(root, "song_ids.json"), "r") as f:
+            song_ids = json.load(f)
+        vectors = np.load(os.path.join(root, "vectors.npy"), mmap_mode="r" if mmap else None)
+        return cls(song_ids, vectors, np.load(os.path.join(root, "beats.npy")))
+
+    def query_batch(self, queries: np.ndarray, k=10, beats: Optional[np.ndarray] = None, exclude: Optional[np.ndarray] = None):
+        '''
+        Brute force top k for every row of queries, return (indices, scores) each len(queries) x k
+        beats masks songs in a different meter, exclude is one song index per query to leave out (e.g. itself)
+        '''
+        scores = np.atleast_2d(queries).astype(np.float32) @ self.vectors.T
+        if beats is not None:
+            scores[np.asarray(beats)[:, None] != self.beats[None, :]] = -np.inf
+        if exclude is not None:
+            scores[np.arange(scores.shape[0]), exclude] = -np.inf
+        idx = _top_k(scores, k)
+        return idx, np.take_along_axis(scores, idx, axis=1)
+
+    def query(self, song_id: str, k=10) -> List[Tuple[str, float]]:
+        i = self.id_map[song_id]
+        idx, scores = self.query_batch(self.vectors[i], k, self.beats[[i]], np.array([i]))
+        return [(self.song_ids[j], float(s)) for j, s in zip(idx[0], scores[0]) if np.isfinite(s)]
+
+
+class IVFIndex:
+    # Inverted file index: songs are bucketed by nearest k-means centroid and a query only scores n_probe buckets
+
+    def __init__(self, index: EmbeddingIndex, n_lists=None, seed=0):
+        self.index = index
+        n = len(index.song_ids)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n)))
+        self.centroids, assignment = kmeans2(index.vectors.astype(np.float64), n_lists, minit="++", seed=seed)
+        self.centroids = self.centroids.astype(np.float32)
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.r_[0, np.cumsum(np.bincount(assignment, minlength=n_lists))]
+
+    def candidates(self, query: np.ndarray, n_probe=8) -> np.ndarray:
+        lists = _top_k(self.centroids @ query.astype(np.float32), n_probe)
+        return np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+
+    def query(self, song_id: str, k=10, n_probe=8) -> List[Tuple[str, float]]:
+        i = self.index.id_map[song_id]
+        query = self.index.vectors[i]
+        cand = self.candidates(query, n_probe)
+        cand = cand[(cand != i) & (self.index.beats[cand] == self.index.beats[i])]
+        if len(cand) == 0:
+            return []
+        scores = self.index.vectors[cand] @ query
+        best = _top_k(scores, k)
+        return [(self.index.song_ids[cand[j]], float(scores[j])) for j in best]
@@ -0,0 +1,131 @@
+import os
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+import utils
+from comparison import Comparison, pitch_class_feature_matrix, simple_compare
+from song import AnalyzedSong
+
+# Nystrom (landmark) approximation of the song x song similarity matrix. Only the n x m block against
+# m landmark songs is computed exactly, K is approximated by C W^+ C^T, with C the n x m block and W the
+# m x m landmark block. Songs are streamed from disk, only the landmarks are kept in memory.
+
+NYSTROM_PATH = os.path.join(utils.OUTPUT_ROOT, "nystrom.npz")
+
+SimilarityFunction = Callable[[AnalyzedSong, AnalyzedSong], Optional[Comparison]]
+
+
+def _score(song1: AnalyzedSong, song2: AnalyzedSong, similarity_function: SimilarityFunction):
+    comp = similarity_function(song1, song2)
+    return 0 if comp is None else comp.total_score
+
+
+def _columns(song_ids: List[str], landmarks: List[int], similarity_function: SimilarityFunction):
+    # Exact scores of every song against the landmarks, one pass over the corpus
+    landmark_songs = [AnalyzedSong(song_ids[l]) for l in landmarks]
+    C = np.zeros((len(song_ids), len(landmarks)))
+    for i, song_id in enumerate(tqdm(song_ids)):
+        song = AnalyzedSong(song_id)
+        C[i] = [_score(song, l, similarity_function) for l in landmark_songs]
+    return C
+
+
+def kmeans_pp_landmarks(song_ids: List[str], m: int, features: Optional[np.ndarray] = None, seed=0) -> List[int]:
+    '''
+    k-means++ seeding on cheap proxy features, by default the pitch class features (one pass over the corpus),
+    or any precomputed n x d rows such as the embedding.py vectors. Seeding never runs the exact similarity.
+    Fewer than m landmarks are returned when the corpus has fewer distinct feature rows.
+    '''
+    if features is None:
+        features, _ = pitch_class_feature_matrix(song_ids)
+    features = np.asarray(features, dtype=np.float64)
+    sq_norms = (features ** 2).sum(axis=1)
+    rng = np.random.default_rng(seed)
+    n = len(song_ids)
+    landmarks = [int(rng.integers(n))]
+    min_dist = np.full(n, np.inf)
+    for _ in range(m):
+        # Squared distance to the newest landmark
+        last = landmarks[-1]
+        min_dist = np.minimum(min_dist, np.maximum(sq_norms + sq_norms[last] - 2 * features @ features[last], 0))
+        # Rounding noise would otherwise make landmarks (or identical songs) selectable again
+        min_dist[min_dist <= 1e-12 * max(sq_norms.max(), 1e-300)] = 0
+        if len(landmarks) == m or min_dist.sum() <= 0: break
+        landmarks.append(int(rng.choice(n, p=min_dist / min_dist.sum())))
+    return sorted(landmarks)
+
+
+class NystromApprox:
+    song_ids: List[str]
+    landmarks: np.ndarray
+    C: np.ndarray  # n x m exact scores against the landmarks
+    embedding: np.ndarray  # n x r, K ~= embedding @ embedding.T
+
+    def __init__(self, song_ids: List[str], landmarks, C: np.ndarray, rtol=1e-8):
+        self.song_ids = song_ids
+        self.landmarks = np.asarray(landmarks)
+        self.C = C
+        W = C[self.landmarks]
+        vals, vecs = np.linalg.eigh((W + W.T) / 2)
+        # simple_compare is not guaranteed PSD, drop the non positive part of the spectrum
+        keep = vals > rtol * max(vals.max(initial=0), 1e-300)
+        self.embedding = C @ (vecs[:, keep] / np.sqrt(vals[keep]))
+
+    @classmethod
+    def build(cls, song_ids: List[str], m: int, method="random", similarity_function: SimilarityFunction = simple_compare,
+              seed=0, features: Optional[np.ndarray] = None):
+        # features: proxy rows for kmeans++ seeding (see kmeans_pp_landmarks)
+        if method == "random":
+            landmarks = sorted(np.random.default_rng(seed).choice(len(song_ids), m, replace=False).tolist())
+        elif method == "kmeans++":
+            landmarks = kmeans_pp_landmarks(song_ids, m, features, seed)
+        else:
+            raise ValueError(method)
+        # All landmarks in memory, one pass over the corpus
+        return cls(song_ids, landmarks, _columns(song_ids, landmarks, similarity_function))
+
+    def save(self, path=NYSTROM_PATH):
+        np.savez(path, song_ids=np.array(self.song_ids), landmarks=self.landmarks, C=self.C)
+
+    @classmethod
+    def load(cls, path=NYSTROM_PATH) -> 'NystromApprox':
+        data = np.load(path)
+        return cls(data["song_ids"].tolist(), data["landmarks"], data["C"])
+
+    def approx(self, i: int, j: int) -> float:
+        return float(self.embedding[i] @ self.embedding[j])
+
+    def row(self, i: int) -> np.ndarray:
+        return self.embedding @ self.embedding[i]
+
+    def matrix(self) -> np.ndarray:
+        # Full n x n reconstruction, only for corpora small enough to hold it
+        return self.embedding @ self.embedding.T
+
+
+def estimate_error(approx: NystromApprox, sample_pairs=500, similarity_function: SimilarityFunction = simple_compare, seed=0) -> Dict:
+    '''
+    Compare the approximation with exact scores on a random sample of song pairs
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(approx.song_ids)
+    pairs = rng.integers(n, size=(sample_pairs, 2))
+    exact = np.zeros(sample_pairs)
+    estimate = np.zeros(sample_pairs)
+    for k, (i, j) in enumerate(tqdm(pairs)):
+        exact[k] = _score(AnalyzedSong(approx.song_ids[i]), AnalyzedSong(approx.song_ids[j]), similarity_function)
+        estimate[k] = approx.approx(i, j)
+
+    diff = estimate - exact
+    norm = np.linalg.norm(exact)
+    return {
+        "pairs": pairs,
+        "exact": exact,
+        "approx": estimate,
+        "mae": float(np.abs(diff).mean()),
+        "rmse": float(np.sqrt((diff ** 2).mean())),
+        "relative_error": float(np.linalg.norm(diff) / norm) if norm > 0 else float("nan"),
+        "correlation": float(np.corrcoef(exact, estimate)[0, 1]) if exact.std() > 0 and estimate.std() > 0 else float("nan"),
+    }
@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from song import ParsedSong
+from tonnetz import compute_chord_transitions
+
+# Time localized matching. Each song becomes a sequence of pitch class transition histograms over sliding
+# windows of measures, and two songs are matched with one matrix product over all window pairs followed by
+# a diagonal (banded) accumulation, so shared passages come out with their measure ranges.
+
+PITCH_CLASSES = 12
+
+
+@dataclass
+class Passage:
+    measures1: Tuple[int, int]  # [from, to) measures in the first song
+    measures2: Tuple[int, int]  # [from, to) measures in the second song
+    score: float  # Mean window cosine similarity along the passage
+    transposition: int = 0  # Semitones added to the second song to line up with the first
+
+    def __repr__(self):
+        return (f"M{self.measures1[0]}-{self.measures1[1]} / M{self.measures2[0]}-{self.measures2[1]}"
+                f" (+{self.transposition}): {round(self.score, 3)}")
+
+
+def measure_histograms(parsed: ParsedSong, tracks: Optional[List[int]] = None) -> np.ndarray:
+    '''
+    Return a (measures, 12 * 12) array of pitch class transition weights summed over tracks
+    '''
+    ticks_per_measure = parsed.beats_per_measure * parsed.ticks_per_beat
+    if tracks is None:
+        tracks = range(len(parsed.note_intervals))
+
+    prev, curr, weights, measures = [], [], [], []
+    for t in tracks:
+        p, c, w, starts = compute_chord_transitions(parsed.note_intervals[t])
+        prev.append(p)
+        curr.append(c)
+        weights.append(w)
+        measures.append(starts // ticks_per_measure)
+    if len(prev) == 0 or sum(len(p) for p in prev) == 0:
+        return np.zeros((0, PITCH_CLASSES * PITCH_CLASSES))
+
+    prev, curr = np.concatenate(prev), np.concatenate(curr)
+    weights, measures = np.concatenate(weights), np.concatenate(measures).astype(np.int64)
+    bins = PITCH_CLASSES * PITCH_CLASSES
+    flat = measures * bins + (prev % PITCH_CLASSES) * PITCH_CLASSES + curr % PITCH_CLASSES
+    hist = np.bincount(flat, weights=weights, minlength=(measures.max() + 1) * bins)
+    return hist.reshape(-1, bins)
+
+
+def window_histograms(hist: np.ndarray, window=4, hop=1) -> np.ndarray:
+    '''
+    Sum measure histograms over sliding windows and L2 normalize each window
+    '''
+    if hist.shape[0] < window:
+        return np.zeros((0, hist.shape[1]))
+    cumsum = np.concatenate((np.zeros((1, hist.shape[1])), np.cumsum(hist, axis=0)))
+    starts = np.arange(0, hist.shape[0] - window + 1, hop)
+    windows = cumsum[starts + window] - cumsum[starts]
+    norms = np.linalg.norm(windows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return windows / norms
+
+
+def _transpose_windows(windows: np.ndarray, semitones: int) -> np.ndarray:
+    # Rotate both pitch class axes of every flattened 12 x 12 histogram
+    cube = windows.reshape(-1, PITCH_CLASSES, PITCH_CLASSES)
+    return np.roll(cube, (semitones, semitones), axis=(1, 2)).reshape(windows.shape[0], -1)
+
+
+def _diagonal_sums(sim: np.ndarray, length: int) -> np.ndarray:
+    # out[i, j] = sum of sim[i + t, j + t] for t < length, one vectorized pass per row
+    acc = np.zeros((sim.shape[0] + 1, sim.shape[1] + 1))
+    for i in range(sim.shape[0]):
+        acc[i + 1, 1:] = acc[i, :-1] + sim[i]
+    return acc[length:, length:] - acc[:-length, :-length]
+
+
+def match_windows(windows1: np.ndarray, windows2: np.ndarray, length=4, top=5, min_score=0.5, transpose=False):
+    '''
+    Return (score, i, j, transposition) for the best aligned runs of length windows, without overlaps
+    '''
+    if windows1.shape[0] < length or windows2.shape[0] < length:
+        return []
+    shifts = range(PITCH_CLASSES) if transpose else [0]
+    candidates = []
+    for shift in shifts:
+        sim = windows1 @ _transpose_windows(windows2, shift).T
+        scores = _diagonal_sums(sim, length) / length
+        idx = np.flatnonzero(scores.ravel() >= min_score)
+        order = idx[np.argsort(scores.ravel()[idx])[::-1]]
+        i, j = np.unravel_index(order, scores.shape)
+        candidates.extend(zip(scores.ravel()[order], i, j, [shift] * len(order)))
+
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    matches = []
+    for score, i, j, shift in candidates:
+        if len(matches) == top: break
+        # Greedily skip runs overlapping an already chosen run in both songs
+        if any(abs(i - mi) < length and abs(j - mj) < length for _, mi, mj, _ in matches):
+            continue
+        matches.append((float(score), int(i), int(j), shift))
+    return matches
+
+
+def match_passages(song1: ParsedSong, song2: ParsedSong, window=4, hop=1, length=4, top=5, min_score=0.5,
+                   transpose=False, tracks1=None, tracks2=None) -> List[Passage]:
+    windows1 = window_histograms(measure_histograms(song1, tracks1), window, hop)
+    windows2 = window_histograms(measure_histograms(song2, tracks2), window, hop)
+    passages = []
+    for score, i, j, shift in match_windows(windows1, windows2, length, top, min_score, transpose):
+        passages.append(Passage(
+            (i * hop, (i + length - 1) * hop + window),
+            (j * hop, (j + length - 1) * hop + window),
+            score, shift
+        ))
+    return passages
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from tqdm import tqdm
+
+from comparison import simple_compare
+from embedding import EmbeddingIndex, EMBEDDING_ROOT
+from song import AnalyzedSong
+
+# Local similarity query server. Loads the analyzed corpus and the embedding index once and answers
+#   GET /topk?song=<id>&k=10[&rerank=50]
+#   GET /compare?a=<id>&b=<id>
+#   GET /instruments?a=<id>&b=<id>&thresh=0.7
+# with JSON, over TCP (python server.py 8227) or a Unix socket (python server.py unix:/tmp/tonnetz.sock).
+# Concurrent top-k queries are batched into one matrix product and recent results are cached. Exact comparisons
+# (/compare, /instruments and top-k reranking) are batched the same way and run on a worker thread, off the event loop.
+
+DEFAULT_PORT = 8227
+BATCH_WINDOW = 0.002  # Seconds to wait for more top-k queries before scoring a batch
+MAX_BATCH = 256
+CACHE_SIZE = 4096
+
+
+class LRUCache:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class SimilarityServer:
+    songs: Dict[str, AnalyzedSong]
+
+    def __init__(self, index: EmbeddingIndex, load_songs=True):
+        self.index = index
+        self.songs = {}
+        if load_songs:
+            for song_id in tqdm(index.song_ids):
+                self.songs[self._key(song_id)] = AnalyzedSong(song_id)
+        self.id_map = {self._key(s): i for i, s in enumerate(index.song_ids)}
+        self.cache = LRUCache()
+        self.queue: Optional[asyncio.Queue] = None
+        self.exact_queue: Optional[asyncio.Queue] = None
+        self.pending: Dict[Tuple, asyncio.Future] = {}  # Exact comparisons queued or running, shared by requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def _key(song_id: str):
+        return song_id[:-len(".pickle")] if song_id.endswith(".pickle") else song_id
+
+    def _song(self, song_id) -> AnalyzedSong:
+        key = self._key(song_id)
+        if key not in self.songs:
+            self.songs[key] = AnalyzedSong(song_id)
+        return self.songs[key]
+
+    # Handlers
+
+    def _compare_batch(self, batch: List[Tuple[str, str, int]]):
+        # Runs on the executor thread. Returns (result, exception) per pair so one bad pair only fails its own request
+        results = []
+        for a, b, max_channels in batch:
+            try:
+                results.append((simple_compare(self._song(a), self._song(b), max_channels=max_channels), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    async def compare_many(self, pairs: List[Tuple[str, str]], max_channels=3):
+        futures = []
+        for a, b in pairs:
+            cache_key = ("compare", self._key(a), self._key(b), max_channels)
+            if cache_key in self.cache.items:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(self.cache.get(cache_key))
+            elif cache_key in self.pending:
+                future = self.pending[cache_key]
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self.pending[cache_key] = future
+                await self.exact_queue.put((cache_key, a, b, max_channels, future))
+            # Shielded so a client disconnecting does not cancel a comparison other requests wait on
+            futures.append(asyncio.shield(future))
+        return await asyncio.gather(*futures)
+
+    async def compare(self, a, b, max_channels=3):
+        return (await self.compare_many([(a, b)], max_channels))[0]
+
+    async def compare_json(self, a, b):
+        comp = await self.compare(a, b)
+        if comp is None:
+            return {"songs": [a, b], "total_score": None, "reason": "different beats per measure"}
+        return {"songs": list(comp.songs), "total_score": comp.total_score,
+                "best": [{"qnote": q, "tracks": list(t), "score": s} for q, t, s in comp.get_best_matches()]}
+
+    async def instruments_json(self, a, b, thresh=0.7):
+        comp = await self.compare(a, b)
+        if comp is None:
+            return {"songs": [a, b], "matches": []}
+        s1, s2 = self._song(a), self._song(b)
+        return {"songs": list(comp.songs), "matches": [
+            {"tracks": list(t), "instruments": [s1.tracks[t[0]].instrument, s2.tracks[t[1]].instrument], "score": score}
+            for t, score in comp.get_best_instrument_matches(thresh)
+        ]}
+
+    async def top_k(self, song_id, k=10, rerank=0):
+        cache_key = ("topk", self._key(song_id), k, rerank)
+        result = self.cache.get(cache_key)
+        if result is not None:
+            return result
+        i = self.id_map[self._key(song_id)]
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((i, max(k, rerank), future))
+        idx, scores = await future
+        result = [(self.index.song_ids[j], float(s)) for j, s in zip(idx, scores) if np.isfinite(s)]
+        if rerank > 0:
+            # Exact simple_compare scores on the embedding candidates
+            comps = await self.compare_many([(song_id, c) for c, _ in result])
+            result = sorted(((c, comp.total_score) for (c, _), comp in zip(result, comps) if comp is not None),
+                            key=lambda r: r[1], reverse=True)
+        result = result[:k]
+        self.cache.put(cache_key, result)
+        return result
+
+    @staticmethod
+    async def _collect(queue: asyncio.Queue):
+        # Wait for one item, then collect more for BATCH_WINDOW
+        batch = [await queue.get()]
+        deadline = asyncio.get_running_loop().time() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0: break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def batcher(self):
+        # Score queued top-k queries with one matrix product
+        while True:
+            batch = await self._collect(self.queue)
+            rows = np.array([b[0] for b in batch])
+            k = max(b[1] for b in batch)
+            try:
+                idx, scores = self.index.query_batch(self.index.vectors[rows], k, self.index.beats[rows], rows)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done(): future.set_exception(e)
+                continue
+            for r, (_, k_r, future) in enumerate(batch):
+                # A client that disconnected leaves a cancelled future
+                if not future.done(): future.set_result((idx[r, :k_r], scores[r, :k_r]))
+
+    async def exact_batcher(self):
+        # Run queued exact comparisons as one batch on the executor thread
+        while True:
+            batch = await self._collect(self.exact_queue)
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._compare_batch, [(a, b, max_channels) for _, a, b, max_channels, _ in batch])
+            except Exception as e:
+                for cache_key, _, _, _, future in batch:
+                    self.pending.pop(cache_key, None)
+                    if not future.done(): future.set_exception(e)
+                continue
+            for (cache_key, _, _, _, future), (result, error) in zip(batch, results):
+                self.pending.pop(cache_key, None)
+                if error is not None:
+                    if not future.done(): future.set_exception(error)
+                    continue
+                self.cache.put(cache_key, result)
+                if not future.done(): future.set_result(result)
+
+    # HTTP
+
+    async def route(self, path: str):
+        url = urlsplit(path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/topk":
+            result = await self.top_k(params["song"], int(params.get("k", 10)), int(params.get("rerank", 0)))
+            return {"song": params["song"], "neighbours": [{"song": s, "score": score} for s, score in result]}
+        if url.path == "/compare":
+            return await self.compare_json(params["a"], params["b"])
+        if url.path == "/instruments":
+            return await self.instruments_json(params["a"], params["b"], float(params.get("thresh", 0.7)))
+        raise KeyError(url.path)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not used
+            parts = request_line.split()
+            try:
+                body, status = await self.route(parts[1]), "200 OK"
+            except (KeyError, IndexError, ValueError, FileNotFoundError) as e:
+                body, status = {"error": repr(e)}, "400 Bad Request"
+            data = json.dumps(body).encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, address=DEFAULT_PORT):
+        self.queue = asyncio.Queue()
+        self.exact_queue = asyncio.Queue()
+        batchers = [asyncio.create_task(self.batcher()), asyncio.create_task(self.exact_batcher())]
+        if isinstance(address, str) and address.startswith("unix:"):
+            server = await asyncio.start_unix_server(self.handle, path=address[len("unix:"):])
+        else:
+            server = await asyncio.start_server(self.handle, "127.0.0.1", int(address))
+        print(f"Serving {len(self.index.song_ids)} songs on {address}")
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                for batcher in batchers:
+                    batcher.cancel()
+                self.executor.shutdown(wait=False)
+
+
+def main():
+    address = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PORT
+    index = EmbeddingIndex.load(EMBEDDING_ROOT)
+    asyncio.run(SimilarityServer(index).serve(address))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
 import comparison
+import corpus
 import sys
 import os
 import utils
 import pickle
 
 def main():
-    songs = sorted(os.listdir(os.path.join(utils.OUTPUT_ROOT, "songPickles")))
-    total = len(os.listdir(os.path.join(utils.OUTPUT_ROOT, "songPickles")))
-    print(total)
+    songs = corpus.song_ids()
+    print(len(songs))
+
+    if sys.argv[1] == "blocks":
+        # Out of core: python simmatrix.py blocks <memory_budget_mb>
+        budget = int(sys.argv[2]) * 2**20
+        comparison.compute_sim_blocks(songs, comparison.simple_compare, memory_budget=budget,
+                                      output_path=os.path.join(utils.OUTPUT_ROOT, "sim_matrix.npy"))
+        return
 
     from_idx = int(sys.argv[1])
     to_idx = int(sys.argv[2])
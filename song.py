@@ -1,4 +1,5 @@
 import csv
+from dataclasses import dataclass
 
 import midiFile
 import utils
@@ -12,7 +13,8 @@ import pickle
 import pretty_midi
 import numpy as np
 import math
-from tonnetz import MatrixType
+from tonnetz import MatrixType, shared_nodes
+from cache import AnalysisCache
 from enum import Enum
 
 
@@ -40,6 +42,44 @@ class SimpleSong:
         return repr([num_to_note(n) for n in self.notes])
 
 
+# Note intervals of every non drum instrument in a MIDI file, before any Tonnetz analysis
+@dataclass
+class ParsedSong:
+    name: str
+    artist: str
+    path: str
+    ticks_per_beat: int
+    beats_per_measure: int
+    instruments: List[str]
+    instrument_indices: List[int]
+    note_intervals: List[np.ndarray]  # [note, start, stop] in ticks, one array per instrument
+
+
+def parse_midi(path) -> ParsedSong:
+    if not os.path.exists(path):
+        path = os.path.join(utils.DATA_ROOT, path)
+    pm = pretty_midi.PrettyMIDI(path)
+    pm.remove_invalid_notes()
+
+    parsed = ParsedSong(
+        name=os.path.splitext(os.path.basename(path))[0],
+        artist=os.path.basename(os.path.dirname(path)),
+        path=path,
+        ticks_per_beat=pm.resolution,
+        beats_per_measure=pm.time_signature_changes[0].numerator,
+        instruments=[], instrument_indices=[], note_intervals=[]
+    )
+    for i, instrument in enumerate(pm.instruments):
+        if instrument.is_drum: continue
+        intervals = np.array([(pm.time_to_tick(note.start), pm.time_to_tick(note.end)) for note in instrument.notes])
+        notes = np.array([note.pitch for note in instrument.notes])
+        notes = notes.reshape(-1, 1)
+        parsed.note_intervals.append(np.concatenate((notes, intervals), 1))
+        parsed.instruments.append(utils.GM_INSTRUMENT_NAMES[instrument.program])
+        parsed.instrument_indices.append(i)
+    return parsed
+
+
 # Collection of TonnetzTracks that represent all the tracks in a MIDI Song
 class AnalyzedSong:
     name: str
@@ -64,30 +104,25 @@ class AnalyzedSong:
             self.load_pickle(path)
 
     def load_song(self, path):
-        if not os.path.exists(path):
-            path = os.path.join(utils.DATA_ROOT, path)
-        pm = pretty_midi.PrettyMIDI(path)
-        pm.remove_invalid_notes()
+        self.analyze_parsed(parse_midi(path))
 
-        self.ticks_per_beat = pm.resolution
-        self.beats_per_measure = pm.time_signature_changes[0].numerator
+    def analyze_parsed(self, parsed: 'ParsedSong', beats_per_measure=None, tonnetz_kwargs: Optional[Dict] = None, **analysis_kwargs):
+        # beats_per_measure overrides the file's first time signature, tonnetz_kwargs are passed to the lattice
+        self.name = parsed.name
+        self.artist = parsed.artist
+        self.path = parsed.path
+        self.ticks_per_beat = parsed.ticks_per_beat
+        self.beats_per_measure = parsed.beats_per_measure if beats_per_measure is None else beats_per_measure
         self.ticks_per_measure = self.beats_per_measure * self.ticks_per_beat
+        self.tracks = []
+        self.instrument_indices = []
 
-        self.path = path
-
-        for i, instrument in enumerate(pm.instruments):
-            if instrument.is_drum: continue
-            intervals = np.array([(pm.time_to_tick(note.start), pm.time_to_tick(note.end)) for note in instrument.notes])
-            notes = np.array([note.pitch for note in instrument.notes])
-            notes = notes.reshape(-1, 1)
-            note_interval = np.concatenate((notes, intervals), 1)
-
-            ts = TonnetzQuarterTrack(instrument=utils.GM_INSTRUMENT_NAMES[instrument.program])
-            if ts.analyze(note_interval, self.ticks_per_measure, self.beats_per_measure):
+        for i, instrument, note_interval in zip(parsed.instrument_indices, parsed.instruments, parsed.note_intervals):
+            ts = TonnetzQuarterTrack(instrument=instrument, **(tonnetz_kwargs or {}))
+            if ts.analyze(note_interval, self.ticks_per_measure, self.beats_per_measure, **analysis_kwargs):
                 self.tracks.append(ts)
                 self.instrument_indices.append(i)
 
-
     def draw(self, output_file=None, save_file=True, show_image=False, draw_quarters=True):
         xplots = 3
         yplots = 3
@@ -164,8 +199,9 @@ class AnalyzedSong:
         
         sim_score = 0
         # Flatten the Laplacian Matrix
-        L1 = track1.get_matrices(MatrixType.LAPLACIAN)
-        L2 = track2.get_matrices(MatrixType.LAPLACIAN)
+        nodes = shared_nodes([track1, track2])
+        L1 = track1.get_matrices(MatrixType.LAPLACIAN, nodes)
+        L2 = track2.get_matrices(MatrixType.LAPLACIAN, nodes)
         
         for i in range(0, len(track1.note_number_transitions)):
             L1_flat = L1[i].flatten()
@@ -190,14 +226,36 @@ class AnalyzedSong:
             
         
 
-def analyze_artist(artist, draw=False, skip_analyzed=True, tqdm_disable=True):
+def analyze_artist(artist, draw=False, skip_analyzed=True, tqdm_disable=True, analysis_cache: Optional[AnalysisCache] = None):
     print(f"ANALYZING {artist}")
-    def callback(artist, song_name):
-        if skip_analyzed and os.path.exists(utils.to_pickle_path(utils.to_song_id(artist, song_name[:-4]))):
-            return
-        anSong = AnalyzedSong(os.path.join(artist, song_name))
+    if analysis_cache is None:
+        analysis_cache = AnalysisCache()
+
+    def analyze(song_id, midi_path, key):
+        anSong = AnalyzedSong(midi_path)
         anSong.draw(save_file=True, show_image=draw)
         anSong.save_pickle()
+        analysis_cache.record(song_id, midi_path, key)
+
+    def callback(artist, song_name):
+        song_id = utils.to_song_id(artist, song_name[:-4])
+        midi_path = os.path.join(utils.DATA_ROOT, artist, song_name)
+        key = analysis_cache.key(song_id, midi_path)
+        # Byte identical files share one pickle under the content's owner, whichever artist is processed first
+        owner = analysis_cache.content_owner(song_id, key.split("-")[0])
+        if owner != song_id:
+            if not analysis_cache.is_valid(owner):
+                owner_path = analysis_cache.songs[owner].get("path")
+                analyze(owner, owner_path, analysis_cache.key(owner, owner_path))
+            analysis_cache.record(song_id, midi_path, key, owner=owner)
+            if os.path.exists(utils.to_pickle_path(song_id)):
+                os.remove(utils.to_pickle_path(song_id))
+            return
+        if skip_analyzed and analysis_cache.owner(key) == song_id and analysis_cache.is_valid(song_id):
+            return
+        analyze(song_id, midi_path, key)
 
-    res = utils.for_song_in_artist(artist, callback, tqdm_disable=tqdm_disable)
+    # Duplicates are found by content hash, so numbered file names are not skipped
+    res = utils.for_song_in_artist(artist, callback, skip_digits=False, tqdm_disable=tqdm_disable)
+    analysis_cache.save()
     print(f"COMPLETED {artist}")
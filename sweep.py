@@ -0,0 +1,169 @@
+import csv
+import itertools
+import json
+import os
+import pickle
+import sys
+from typing import Dict, List, Tuple
+
+from tqdm import tqdm
+
+import utils
+import tonnetz
+from comparison import edge_list_tonnetz_distance
+from song import AnalyzedSong, ParsedSong, parse_midi
+
+# Parameter sweeps. Every MIDI file is parsed once into note intervals, then each song is analyzed once
+# per (beats_per_measure, lattice) setting with the loosest distance threshold. DIST_THRESH and
+# MIN_TRANSITIONS only decide which tracks are kept, so they are applied afterwards, and track pair
+# scores are memoized across every setting that keeps the same tracks.
+
+INTERVAL_ROOT = os.path.join(utils.OUTPUT_ROOT, "noteIntervals")
+SWEEP_ROOT = os.path.join(utils.OUTPUT_ROOT, "sweep")
+
+DEFAULT_GRID = {
+    "dist_thresh": [tonnetz.DIST_THRESH],
+    "min_transitions": [tonnetz.MIN_TRANSITIONS],
+    "beats_per_measure": [None],  # None uses the file's time signature
+    "lattice": [(tonnetz.DEFAULT_X, tonnetz.DEFAULT_Y)],
+    "max_channels": [3],
+}
+
+
+def to_interval_path(song_id: str):
+    return os.path.join(INTERVAL_ROOT, f"{song_id}.pickle")
+
+
+def parse_corpus(midi_paths: List[str], skip_parsed=True) -> List[str]:
+    '''
+    Parse every MIDI file into note intervals and store them, return the song ids
+    '''
+    os.makedirs(INTERVAL_ROOT, exist_ok=True)
+    song_ids = []
+    for path in tqdm(midi_paths):
+        try:
+            song_id = utils.to_song_id(os.path.basename(os.path.dirname(path)), os.path.splitext(os.path.basename(path))[0])
+            if not (skip_parsed and os.path.exists(to_interval_path(song_id))):
+                parsed = parse_midi(path)
+                with open(to_interval_path(song_id), "wb") as handle:
+                    pickle.dump(parsed, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            song_ids.append(song_id)
+        except Exception as e:
+            print(f"{path}: {e}")
+    return song_ids
+
+
+def load_parsed(song_id: str) -> ParsedSong:
+    with open(to_interval_path(song_id), "rb") as handle:
+        return pickle.load(handle)
+
+
+def expand_grid(grid: Dict[str, list]) -> List[Dict]:
+    grid = {**DEFAULT_GRID, **grid}
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def setting_name(setting: Dict):
+    lattice = setting["lattice"]
+    bpm = "file" if setting["beats_per_measure"] is None else setting["beats_per_measure"]
+    return (f"dist{setting['dist_thresh']}-min{setting['min_transitions']}-bpm{bpm}"
+            f"-lat{lattice[0]}x{lattice[1]}-ch{setting['max_channels']}")
+
+
+def _kept_tracks(song: AnalyzedSong, dist_thresh, min_transitions) -> Tuple[int, ...]:
+    # Indices of the tracks TonnetzQuarterTrack.analyze would keep with these parameters
+    kept = []
+    for t, track in enumerate(song.tracks):
+        counts = [sum(1 for c0, c1 in qtrans if tonnetz.dist(c0, c1, track.pos) < dist_thresh)
+                  for qtrans in track.transitions]
+        if not all(count < min_transitions for count in counts):
+            kept.append(t)
+    return tuple(kept)
+
+
+class _TrackPairScores:
+    # Memoized simple_compare score of one track pair, summed over beats
+    def __init__(self, songs: List[AnalyzedSong]):
+        self.songs = songs
+        self.scores: Dict[Tuple[int, int, int, int], float] = {}
+
+    def get(self, i, a, j, b):
+        key = (i, a, j, b)
+        if key not in self.scores:
+            tr1 = self.songs[i].tracks[a]
+            tr2 = self.songs[j].tracks[b]
+            self.scores[key] = sum(
+                edge_list_tonnetz_distance(tr1.note_number_transitions[q], tr2.note_number_transitions[q])
+                for q in range(len(tr1.note_number_transitions))
+            )
+        return self.scores[key]
+
+
+def _compare_setting(songs: List[AnalyzedSong], kept: List[Tuple[int, ...]], max_channels, pair_scores: _TrackPairScores):
+    # Same totals as comparison.simple_compare on songs analyzed with this setting
+    rows = []
+    for i in range(len(songs)):
+        for j in range(i, len(songs)):
+            if songs[i].beats_per_measure != songs[j].beats_per_measure: continue
+            total = 0
+            for a in kept[i][:max_channels]:
+                for b in kept[j][:max_channels]:
+                    total += pair_scores.get(i, a, j, b)
+            rows.append((songs[i].to_song_id(), songs[j].to_song_id(), total))
+    return rows
+
+
+def run_sweep(song_ids: List[str], grid: Dict[str, list], output_root=SWEEP_ROOT):
+    '''
+    Analyze and compare song_ids for every setting in grid, write one csv per setting and a settings.csv index
+    '''
+    os.makedirs(output_root, exist_ok=True)
+    settings = expand_grid(grid)
+    parsed = [load_parsed(s) for s in song_ids]
+
+    groups: Dict[Tuple, List[Dict]] = {}
+    for setting in settings:
+        groups.setdefault((setting["beats_per_measure"], tuple(setting["lattice"])), []).append(setting)
+
+    for (beats_per_measure, lattice), group in groups.items():
+        loosest = max(s["dist_thresh"] for s in group)
+        songs = []
+        for p in tqdm(parsed):
+            song = AnalyzedSong()
+            song.analyze_parsed(p, beats_per_measure, {"x": lattice[0], "y": lattice[1]},
+                                dist_thresh=loosest, min_transitions=0)
+            songs.append(song)
+
+        pair_scores = _TrackPairScores(songs)
+        for setting in group:
+            kept = [_kept_tracks(s, setting["dist_thresh"], setting["min_transitions"]) for s in songs]
+            rows = _compare_setting(songs, kept, setting["max_channels"], pair_scores)
+            with open(os.path.join(output_root, f"{setting_name(setting)}.csv"), "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["song1", "song2", "total_score"])
+                writer.writerows(rows)
+
+    with open(os.path.join(output_root, "settings.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name"] + list(settings[0].keys()))
+        for setting in settings:
+            writer.writerow([setting_name(setting)] + list(setting.values()))
+    return settings
+
+
+def main():
+    # python sweep.py <grid.json> <artist> [<artist> ...]
+    with open(sys.argv[1], "r") as f:
+        grid = json.load(f)
+    midi_paths = []
+    for artist in sys.argv[2:]:
+        utils.for_song_in_artist(artist, lambda a, name: midi_paths.append(os.path.join(utils.DATA_ROOT, a, name)),
+                                 skip_digits=False, tqdm_disable=True)
+    song_ids = parse_corpus(midi_paths)
+    settings = run_sweep(song_ids, grid)
+    print(f"Wrote {len(settings)} settings to {SWEEP_ROOT}")
+
+
+if __name__ == "__main__":
+    main()
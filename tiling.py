@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import sys
+from dataclasses import dataclass, asdict
+from typing import List, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+import comparison
+import corpus
+import utils
+from song import AnalyzedSong
+
+# Splits the upper triangle of the similarity matrix into square tiles and
+# spreads them over workers so every node does roughly the same number of comparisons.
+# Workers only need a shared filesystem: the manifest and shards live in TILE_ROOT.
+# Shard names carry the plan id (a hash of the song ids and tile size), so shards of an older plan are never
+# reused or merged after replanning.
+
+TILE_ROOT = os.path.join(utils.OUTPUT_ROOT, "tiles")
+MANIFEST_NAME = "manifest.json"
+DEFAULT_TILE_SIZE = 64
+
+
+@dataclass
+class Tile:
+    id: int
+    rows: Tuple[int, int]  # [from, to)
+    cols: Tuple[int, int]  # [from, to)
+    cost: int  # Number of song pairs compared in this tile
+    worker: int = -1
+
+    def is_diagonal(self):
+        return self.rows == self.cols
+
+
+def _tile_cost(rows, cols):
+    # Pairs (i, j) with j >= i inside the tile
+    if rows == cols:
+        size = rows[1] - rows[0]
+        return size * (size + 1) // 2
+    return (rows[1] - rows[0]) * (cols[1] - cols[0])
+
+
+def plan_tiles(n: int, workers: int, tile_size=DEFAULT_TILE_SIZE) -> List[Tile]:
+    bounds = [(start, min(start + tile_size, n)) for start in range(0, n, tile_size)]
+    tiles = []
+    for bi, rows in enumerate(bounds):
+        for cols in bounds[bi:]:
+            tiles.append(Tile(len(tiles), rows, cols, _tile_cost(rows, cols)))
+
+    # Greedy longest-processing-time assignment: biggest tiles first, to the least loaded worker
+    loads = [0] * workers
+    for tile in sorted(tiles, key=lambda t: t.cost, reverse=True):
+        worker = loads.index(min(loads))
+        tile.worker = worker
+        loads[worker] += tile.cost
+    return tiles
+
+
+def plan_id(song_ids: List[str], tile_size: int) -> str:
+    return hashlib.sha1(json.dumps([song_ids, tile_size]).encode()).hexdigest()[:12]
+
+
+def write_manifest(song_ids: List[str], workers: int, tile_size=DEFAULT_TILE_SIZE, tile_root=TILE_ROOT):
+    tiles = plan_tiles(len(song_ids), workers, tile_size)
+    manifest = {
+        "plan_id": plan_id(song_ids, tile_size),
+        "song_ids": song_ids,
+        "workers": workers,
+        "tile_size": tile_size,
+        "tiles": [asdict(t) for t in tiles],
+    }
+    os.makedirs(tile_root, exist_ok=True)
+    # Shards of any other plan are stale
+    for name in os.listdir(tile_root):
+        if name.startswith("tile-") and not name.startswith(f"tile-{manifest['plan_id']}-"):
+            os.remove(os.path.join(tile_root, name))
+    with open(os.path.join(tile_root, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_manifest(tile_root=TILE_ROOT):
+    with open(os.path.join(tile_root, MANIFEST_NAME), "r") as f:
+        manifest = json.load(f)
+    manifest["tiles"] = [Tile(t["id"], tuple(t["rows"]), tuple(t["cols"]), t["cost"], t["worker"])
+                         for t in manifest["tiles"]]
+    # Always derived from the plan itself, so an edited or older manifest cannot point at another plan's shards
+    manifest["plan_id"] = plan_id(manifest["song_ids"], manifest["tile_size"])
+    return manifest
+
+
+def to_shard_path(manifest, tile: Tile, tile_root=TILE_ROOT):
+    return os.path.join(tile_root, f"tile-{manifest['plan_id']}-{tile.rows[0]}-{tile.cols[0]}.npy")
+
+
+def compute_tile(song_ids: List[str], tile: Tile, similarity_function=comparison.simple_compare):
+    row_songs = [AnalyzedSong(song_ids[i]) for i in range(*tile.rows)]
+    if tile.is_diagonal():
+        col_songs = row_songs
+    else:
+        col_songs = [AnalyzedSong(song_ids[j]) for j in range(*tile.cols)]
+
+    block = np.zeros((len(row_songs), len(col_songs)))
+    for r, i in enumerate(range(*tile.rows)):
+        for c, j in enumerate(range(*tile.cols)):
+            if j < i: continue
+            comp = similarity_function(row_songs[r], col_songs[c])
+            if comp is None: continue
+            block[r, c] = comp.total_score
+    return block
+
+
+def save_shard(block: np.ndarray, path: str):
+    # Write then rename so other nodes never see a half written shard
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, block)
+    os.replace(tmp_path, path)
+
+
+def run_worker(worker: int, tile_root=TILE_ROOT, skip_done=True):
+    manifest = load_manifest(tile_root)
+    song_ids = manifest["song_ids"]
+    tiles = [t for t in manifest["tiles"] if t.worker == worker]
+    for tile in tqdm(tiles):
+        path = to_shard_path(manifest, tile, tile_root)
+        if skip_done and os.path.exists(path):
+            continue
+        save_shard(compute_tile(song_ids, tile), path)
+
+
+def missing_tiles(manifest, tile_root=TILE_ROOT) -> List[Tile]:
+    return [t for t in manifest["tiles"] if not os.path.exists(to_shard_path(manifest, t, tile_root))]
+
+
+def merge_shards(output_path=None, tile_root=TILE_ROOT):
+    manifest = load_manifest(tile_root)
+    missing = missing_tiles(manifest, tile_root)
+    if len(missing) > 0:
+        workers = sorted(set(t.worker for t in missing))
+        raise ValueError(f"{len(missing)} tiles missing, owned by workers {workers}")
+
+    n = len(manifest["song_ids"])
+    expected = set((t.rows, t.cols) for t in plan_tiles(n, 1, manifest["tile_size"]))
+    planned = set((t.rows, t.cols) for t in manifest["tiles"])
+    if expected != planned:
+        raise ValueError(f"Manifest tiles do not cover the matrix: {len(expected - planned)} blocks uncovered")
+
+    if output_path is None:
+        output_path = os.path.join(utils.OUTPUT_ROOT, "sim_matrix.npy")
+    sim_mat = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float64, shape=(n, n))
+    for tile in tqdm(manifest["tiles"]):
+        block = np.load(to_shard_path(manifest, tile, tile_root), mmap_mode="r")
+        rs, cs = slice(*tile.rows), slice(*tile.cols)
+        if block.shape != (tile.rows[1] - tile.rows[0], tile.cols[1] - tile.cols[0]):
+            raise ValueError(f"Tile {tile.id} has shape {block.shape}")
+        if tile.is_diagonal():
+            sim_mat[rs, cs] = np.triu(block) + np.triu(block, 1).T
+        else:
+            sim_mat[rs, cs] = block
+            sim_mat[cs, rs] = block.T
+
+    sim_mat.flush()
+    return sim_mat
+
+
+def main():
+    command = sys.argv[1]
+    if command == "plan":
+        # python tiling.py plan <workers> [tile_size]
+        songs = corpus.song_ids()
+        tile_size = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_TILE_SIZE
+        manifest = write_manifest(songs, int(sys.argv[2]), tile_size)
+        print(f"Planned {len(manifest['tiles'])} tiles for {len(songs)} songs")
+    elif command == "run":
+        # python tiling.py run <worker>
+        run_worker(int(sys.argv[2]))
+    elif command == "merge":
+        # python tiling.py merge [output_path]
+        merge_shards(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        raise ValueError(command)
+
+
+if __name__ == "__main__":
+    main()
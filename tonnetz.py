@@ -14,27 +14,97 @@ from overrides import overrides
 
 Coord = Tuple[int, int]
 DEFAULT_START = 57  # A3
+DEFAULT_INTERVALS = (3, 4, 5)
+DEFAULT_X = 12
+DEFAULT_Y = 24
 
 TONNETZ_INTERVALS = (
     (1,1,10), (1,2,9), (1,3,8), (1,4,7), (1,5,6), (2,2,8),
     (2,3,7), (2,4,6), (2,5,5), (3,4,5), (3,3,6), (4,4,4)
 )
 
+_LATTICE_CACHE: Dict[Tuple, Tuple] = {}
+_EDGE_CACHE: Dict[Tuple, Dict[Tuple[int, int], List]] = {}  # (lattice key, dist_thresh) -> note pair -> lattice edges
+
+
 class Tonnetz:
-    def __init__(self, intervals: Tuple[int, int, int] = (3, 4, 5), x: int = 12, y: int = 24,
-                 start_note=DEFAULT_START):
-        self.G = nx.triangular_lattice_graph(x, y)
-        pos = nx.get_node_attributes(self.G, "pos")
-        self.pos = rotate_positions(pos, 30)
-        self._compute_notes(intervals, start_note)
+    lattice: Optional['AnalyticTonnetz'] = None  # Set in analytic mode, G/pos/notes are then only built to draw
+    lattice_key: Optional[Tuple] = None
+
+    def __init__(self, intervals: Optional[Tuple[int, int, int]] = None, x: Optional[int] = None, y: Optional[int] = None,
+                 start_note=None, analytic=False, torus=False):
+        # Defaults are read at call time, so changing the module constants at runtime applies (see cache.analysis_params)
+        if intervals is None: intervals = DEFAULT_INTERVALS
+        if x is None: x = DEFAULT_X
+        if y is None: y = DEFAULT_Y
+        if start_note is None: start_note = DEFAULT_START
+        if analytic:
+            self.lattice = AnalyticTonnetz(intervals, start_note, torus)
+            self.lattice_key = ("analytic", tuple(intervals), start_note, torus)
+            self.G, self.pos, self.notes, self.note_map = None, None, None, None
+            return
+        key = (tuple(intervals), x, y, start_note)
+        self.lattice_key = key
+        if key not in _LATTICE_CACHE:
+            # Every track shares the same lattice, only build it once per parameter set
+            self.G = nx.triangular_lattice_graph(x, y)
+            pos = nx.get_node_attributes(self.G, "pos")
+            self.pos = rotate_positions(pos, 30)
+            self._compute_notes(intervals, start_note)
+            _LATTICE_CACHE[key] = (self.G, self.pos, self.notes, self.note_map)
+        self.G, self.pos, self.notes, self.note_map = _LATTICE_CACHE[key]
 
     def draw(self, draw_edges=True, ax=None):
+        if self.lattice is not None:
+            self.G, self.pos, self.notes = self.lattice.to_graph(self._drawn_coords())
         if draw_edges:
             nx.draw(self.G, self.pos, node_size=150, ax=ax)
         else:
             nx.draw_networkx_nodes(self.G, self.pos, node_size=150, ax=ax)
         nx.draw_networkx_labels(self.G, self.pos, self.notes, font_size=6, ax=ax)
 
+    def _drawn_coords(self):
+        # Analytic mode only draws the part of the lattice that is used
+        return self.lattice.region(2)
+
+    def _has_note(self, note):
+        if self.lattice is not None:
+            return self.lattice.has_note(note)
+        return note in self.note_map
+
+    def _coord_transitions(self, prev, note, dist_thresh):
+        # Edges from every position of prev to the closest position of note
+        if self.lattice is not None:
+            if self.lattice.edge_length(prev, note) >= dist_thresh: return []
+            return [self.lattice.edge(prev, note)]
+
+        transitions = []
+        for prevCoord in self.note_map[prev]:
+            closest = None
+            closest_dist = None
+            for currCoord in self.note_map[note]:
+                d = dist(prevCoord, currCoord, self.pos)
+                if closest is None or d < closest_dist:
+                    closest = currCoord
+                    closest_dist = d
+            if closest_dist < dist_thresh:
+                transitions.append((prevCoord, closest))
+        return transitions
+
+    def _pair_transitions(self, prev, note, dist_thresh):
+        # _coord_transitions memoized per lattice, tracks on the same lattice share the pair -> edge mapping
+        if self.lattice_key is None:
+            return self._coord_transitions(prev, note, dist_thresh)
+        edges = _EDGE_CACHE.setdefault((self.lattice_key, dist_thresh), {})
+        if (prev, note) not in edges:
+            edges[(prev, note)] = self._coord_transitions(prev, note, dist_thresh)
+        return edges[(prev, note)]
+
+    def _valid_notes(self, notes: np.ndarray) -> np.ndarray:
+        # Vectorized _has_note, one lookup per distinct note
+        uniq, inverse = np.unique(notes, return_inverse=True)
+        return np.array([self._has_note(int(n)) for n in uniq], dtype=bool)[inverse.reshape(-1)]
+
     def _compute_notes(self, intervals, start_note):
         self.notes: Dict[Coord, str] = {name: "A" for name in self.G.nodes()}  # Maps note coord to note name
         self.note_map: Dict[int, List[Coord]] = {}  # Maps note number to list of positions in Graph
@@ -70,6 +140,111 @@ def dist(fromCoord, toCoord, pos):
     return math.sqrt((pos[fromCoord][0] - pos[toCoord][0])**2 + (pos[fromCoord][1] - pos[toCoord][1])**2)
 
 
+def _extended_gcd(a, b):
+    # Return (g, x, y) with a * x + b * y = g
+    if b == 0: return a, 1, 0
+    g, x, y = _extended_gcd(b, a % b)
+    return g, y, x - (a // b) * y
+
+
+def hex_norm(u, v):
+    # Lattice steps from the origin with neighbours (+-1, 0), (0, +-1), +-(1, 1)
+    return (abs(u) + abs(v) + abs(u - v)) // 2
+
+
+class AnalyticTonnetz:
+    '''
+    Closed form Tonnetz: coordinate (u, v) holds pitch start_note + a * u + b * v for intervals (a, b, c),
+    so (1, 1) is a + b = 12 - c, the third side of each triangle. The lattice is unbounded, or a torus over
+    pitch classes, pitch to coordinate and transition to edge are constant time arithmetic, and a graph is
+    only built for drawing.
+    '''
+
+    def __init__(self, intervals: Tuple[int, int, int] = DEFAULT_INTERVALS, start_note=DEFAULT_START, torus=False):
+        self.a, self.b = intervals[0], intervals[1]
+        self.start_note = start_note
+        self.torus = torus
+        self.g, self.x0, self.y0 = _extended_gcd(self.a, self.b)
+        self.period = len(NOTE_LOOKUP)
+        if torus:
+            # Shortest displacement for each pitch class difference, trying nearby octaves
+            self._disp = [self._min_torus_solution(d) for d in range(self.period)]
+
+    def _min_solution(self, d) -> Optional[Coord]:
+        # Shortest (u, v) with a * u + b * v = d, solutions are spaced by (b / g, -a / g)
+        if d % self.g != 0: return None
+        scale = d // self.g
+        u0, v0 = self.x0 * scale, self.y0 * scale
+        su, sv = self.b // self.g, -self.a // self.g
+        # hex_norm is convex and piecewise linear in k, so the optimum is next to a breakpoint
+        candidates = set()
+        for k in (-u0 / su, -v0 / sv, (v0 - u0) / (su - sv)):
+            candidates.update((math.floor(k), math.ceil(k)))
+        best = min(candidates, key=lambda k: (hex_norm(u0 + k * su, v0 + k * sv), u0 + k * su, v0 + k * sv))
+        return u0 + best * su, v0 + best * sv
+
+    def _min_torus_solution(self, d) -> Optional[Coord]:
+        solutions = [self._min_solution(d + m * self.period) for m in range(-2, 3)]
+        solutions = [s for s in solutions if s is not None]
+        if len(solutions) == 0: return None
+        return min(solutions, key=lambda s: (hex_norm(*s), s))
+
+    def _displacement(self, prev, note) -> Optional[Coord]:
+        if self.torus:
+            return self._disp[(note - prev) % self.period]
+        return self._min_solution(note - prev)
+
+    def has_note(self, note) -> bool:
+        return self.coord(note) is not None
+
+    def coord(self, note) -> Optional[Coord]:
+        if self.torus:
+            return self._disp[(note - self.start_note) % self.period]
+        return self._min_solution(note - self.start_note)
+
+    def pitch(self, coord: Coord) -> int:
+        pitch = self.start_note + self.a * coord[0] + self.b * coord[1]
+        return pitch % self.period if self.torus else pitch
+
+    def edge(self, prev, note) -> Tuple[Coord, Coord]:
+        # From the position of prev to the closest position of note
+        start = self.coord(prev)
+        if self.torus:
+            return start, self.coord(note)
+        du, dv = self._displacement(prev, note)
+        return start, (start[0] + du, start[1] + dv)
+
+    def edge_length(self, prev, note) -> float:
+        du, dv = self._displacement(prev, note)
+        x, y = self.position((du, dv))
+        return math.sqrt(x ** 2 + y ** 2)
+
+    @staticmethod
+    def position(coord: Coord) -> Tuple[float, float]:
+        return coord[0] - coord[1] / 2, coord[1] * math.sqrt(3) / 2
+
+    @staticmethod
+    def neighbours(coord: Coord) -> List[Coord]:
+        u, v = coord
+        return [(u + 1, v), (u - 1, v), (u, v + 1), (u, v - 1), (u + 1, v + 1), (u - 1, v - 1)]
+
+    def region(self, radius) -> List[Coord]:
+        return [(u, v) for u in range(-radius, radius + 1) for v in range(-radius, radius + 1) if hex_norm(u, v) <= radius]
+
+    def to_graph(self, coords):
+        # Lattice graph spanning coords (and their neighbours in coords), for drawing only
+        coords = set(coords)
+        G = nx.Graph()
+        G.add_nodes_from(coords)
+        G.add_edges_from((c, n) for c in coords for n in self.neighbours(c)[::2] if n in coords)
+        pos = {c: self.position(c) for c in coords}
+        if self.torus:
+            notes = {c: NOTE_LOOKUP[self.pitch(c)] for c in coords}
+        else:
+            notes = {c: num_to_note(self.pitch(c)) for c in coords}
+        return G, pos, notes
+
+
 DIST_THRESH = 4
 WIDTH_ADJUST = 10
 MAX_EDGE_WIDTH = 4
@@ -85,6 +260,35 @@ def _compute_transitions(prev_notes, curr_notes):
     return transitions
 
 
+def compute_chord_transitions(intervals: np.ndarray):
+    '''
+    Vectorized _compute_transitions over a whole [note, start, stop] array, grouping notes by onset like the analyze loops.
+    Return (prev_notes, notes, weights, starts), weights are 1/len(transitions) of the onset and starts is the onset
+    of the later chord. As in the loops, the final onset is never flushed.
+    '''
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64))
+    n = intervals.shape[0]
+    if n == 0: return empty
+    starts = intervals[:, 1]
+    group_starts = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+    sizes = np.diff(np.r_[group_starts, n])
+    group_count = len(group_starts)
+    if group_count < 3: return empty
+
+    # Every (prev, curr) pair between chord g - 1 and chord g, in the same order as the nested loops
+    groups = np.arange(1, group_count - 1)
+    pair_counts = sizes[groups - 1] * sizes[groups]
+    pair_group = np.repeat(groups, pair_counts)
+    k = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    prev_notes = intervals[group_starts[pair_group - 1] + k // sizes[pair_group], 0]
+    notes = intervals[group_starts[pair_group] + k % sizes[pair_group], 0]
+
+    keep = prev_notes != notes
+    prev_notes, notes, pair_group = prev_notes[keep], notes[keep], pair_group[keep]
+    weights = 1 / np.bincount(pair_group, minlength=group_count)[pair_group]
+    return prev_notes, notes, weights, starts[group_starts[pair_group]]
+
+
 class TonnetzTrack(Tonnetz):
     instrument: str
 
@@ -93,52 +297,64 @@ class TonnetzTrack(Tonnetz):
         self.transitions: Dict[Tuple[Coord, Coord], float] = {}
         self.instrument = instrument
 
-    def analyze(self, note_sequence: List[int]):
+    def analyze(self, note_sequence):
+        # note_sequence: list or array of note numbers, every consecutive pair of lattice notes is a transition
         self.transitions = {}
-        prev = None
-        for note in note_sequence:
-            if prev is None or note not in self.note_map or prev not in self.note_map:
-                prev = note
-                continue
-            self._add_transition(prev, note, 1/len(note_sequence))
-            prev = note
+        notes = np.asarray(note_sequence, dtype=np.int64)
+        if len(notes) < 2: return
+        self.add_transitions(notes[:-1], notes[1:], np.full(len(notes) - 1, 1 / len(notes)))
 
     def _add_transition(self, prev, note, weight):
-        if note not in self.note_map: return
-        if prev not in self.note_map: return
+        if not self._has_note(note): return
+        if not self._has_note(prev): return
 
-        for prevCoord in self.note_map[prev]:
-            closest = None
-            closest_dist = None
-            for currCoord in self.note_map[note]:
-                d = dist(prevCoord, currCoord, self.pos)
-                if closest is None or d < closest_dist:
-                    closest = currCoord
-                    closest_dist = d
-            if closest_dist < DIST_THRESH:
-                transition = (prevCoord, closest)
-                if transition not in self.transitions:
-                    self.transitions[transition] = 0
-                self.transitions[transition] += weight
+        for transition in self._pair_transitions(prev, note, DIST_THRESH):
+            if transition not in self.transitions:
+                self.transitions[transition] = 0
+            self.transitions[transition] += weight
+
+    def add_transitions(self, prev_notes: np.ndarray, notes: np.ndarray, weights: np.ndarray):
+        '''
+        Bulk _add_transition: each distinct note pair is mapped to its lattice edges once, in order of first
+        occurrence, and every edge's weight is summed in sequence order with one bincount
+        '''
+        keep = self._valid_notes(prev_notes) & self._valid_notes(notes)
+        prev_notes, notes = prev_notes[keep], notes[keep]
+        if len(notes) == 0: return
+        # Pairs packed into one integer so np.unique sorts a flat array
+        low = min(prev_notes.min(), notes.min())
+        span = max(prev_notes.max(), notes.max()) - low + 1
+        _, first, inverse = np.unique((prev_notes - low) * span + (notes - low), return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # Edge ids in first seen order, several pairs can share an edge on the torus
+        edge_ids: Dict[Tuple[Coord, Coord], int] = {}
+        pair_edges = [None] * len(first)
+        for u in np.argsort(first):
+            pair_edges[u] = [edge_ids.setdefault(t, len(edge_ids))
+                             for t in self._pair_transitions(int(prev_notes[first[u]]), int(notes[first[u]]), DIST_THRESH)]
+        edge_counts = np.array([len(e) for e in pair_edges])
+        flat_edges = np.array([e for edges in pair_edges for e in edges], dtype=np.int64)
+        edge_offsets = np.cumsum(edge_counts) - edge_counts
+
+        # One entry per (occurrence, edge), in the order the loop would add them
+        counts = edge_counts[inverse]
+        occurrence = np.repeat(np.arange(len(inverse)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        entry_edges = flat_edges[edge_offsets[inverse[occurrence]] + within]
+        totals = np.bincount(entry_edges, weights=weights[keep][occurrence], minlength=len(edge_ids))
+        for transition, e in edge_ids.items():
+            self.transitions[transition] = self.transitions.get(transition, 0) + totals[e]
 
     def analyzeV2(self, intervals: np.ndarray):
         # intervals: [note, start, stop]
+        prev_notes, notes, weights, _ = compute_chord_transitions(intervals)
+        self.add_transitions(prev_notes, notes, weights / intervals.shape[0])
 
-        prev_notes = []
-        curr_notes = []
-        curr_start = 0
-
-        for i in range(intervals.shape[0]):
-            if intervals[i,1] != curr_start:
-                trans = _compute_transitions(prev_notes, curr_notes)
-                for t in trans:
-                    self._add_transition(t[0], t[1], (1/len(trans)) / intervals.shape[0])
-                prev_notes = curr_notes
-                curr_notes = []
-
-            curr_start = intervals[i, 1]
-            curr_notes.append(intervals[i, 0])
 
+    @overrides
+    def _drawn_coords(self):
+        return set(c for t in self.transitions for c in t) or self.lattice.region(2)
 
     @overrides
     def draw(self, draw_edges=False, edge_width_adjust=WIDTH_ADJUST, ax=None):
@@ -171,31 +387,24 @@ class TonnetzQuarterTrack(Tonnetz):
         self.note_number_transitions: List[NoteTransitions] = []
         self.instrument = instrument
 
-    def _add_transition(self, prev, note, weight, qnote):
+    def _add_transition(self, prev, note, weight, qnote, dist_thresh=DIST_THRESH):
         if qnote >= len(self.transitions): raise ValueError(f"Quarter {qnote}")
-        if note not in self.note_map: return
-        if prev not in self.note_map: return
+        if not self._has_note(note): return
+        if not self._has_note(prev): return
 
         if (prev, note) not in self.note_number_transitions[qnote]:
             self.note_number_transitions[qnote][(prev, note)] = 0
         self.note_number_transitions[qnote][(prev, note)] += weight
 
-        for prevCoord in self.note_map[prev]:
-            closest = None
-            closest_dist = None
-            for currCoord in self.note_map[note]:
-                d = dist(prevCoord, currCoord, self.pos)
-                if closest is None or d < closest_dist:
-                    closest = currCoord
-                    closest_dist = d
-            if closest_dist < DIST_THRESH:
-                transition = (prevCoord, closest)
-                if transition not in self.transitions[qnote]:
-                    self.transitions[qnote][transition] = 0
-                self.transitions[qnote][transition] += weight
+        for transition in self._coord_transitions(prev, note, dist_thresh):
+            if transition not in self.transitions[qnote]:
+                self.transitions[qnote][transition] = 0
+            self.transitions[qnote][transition] += weight
 
-    def analyze(self, intervals: np.ndarray, ticks_per_measure, beats_per_measure=4):
+    def analyze(self, intervals: np.ndarray, ticks_per_measure, beats_per_measure=4, dist_thresh=None, min_transitions=None):
         # intervals: [note, start, stop]
+        if dist_thresh is None: dist_thresh = DIST_THRESH
+        if min_transitions is None: min_transitions = MIN_TRANSITIONS
         self.transitions = [{} for _ in range(beats_per_measure)]
         self.note_number_transitions = [{} for _ in range(beats_per_measure)]
 
@@ -210,7 +419,7 @@ class TonnetzQuarterTrack(Tonnetz):
                 trans = _compute_transitions(prev_notes, curr_notes)
                 qnote = (curr_start // ticks_per_measure) % beats_per_measure
                 for t in trans:
-                    self._add_transition(t[0], t[1], (1/len(trans)), qnote)
+                    self._add_transition(t[0], t[1], (1/len(trans)), qnote, dist_thresh)
                 prev_notes = curr_notes
                 curr_notes = []
                 trans_per_qnote[qnote] += 1
@@ -220,9 +429,25 @@ class TonnetzQuarterTrack(Tonnetz):
 
         self._adjust_transitions(trans_per_qnote)
 
-        return not (all(len(qt) < MIN_TRANSITIONS for qt in self.transitions))
+        return not (all(len(qt) < min_transitions for qt in self.transitions))
 
 
+    def pitch_class_transitions(self, octave_direction=False) -> np.ndarray:
+        '''
+        Fold note_number_transitions onto pitch classes as a dense (beats, 12, 12) float32 tensor.
+        With octave_direction, return (beats, 2, 12, 12) with rising and falling transitions separated.
+        '''
+        pcs = len(NOTE_LOOKUP)
+        channels = 2 if octave_direction else 1
+        folded = np.zeros((len(self.note_number_transitions), channels, pcs, pcs), dtype=np.float32)
+        for qnote, qtrans in enumerate(self.note_number_transitions):
+            if len(qtrans) == 0: continue
+            pairs = np.array(list(qtrans.keys()))
+            weights = np.array(list(qtrans.values()), dtype=np.float32)
+            direction = (pairs[:, 1] < pairs[:, 0]).astype(np.int64) if octave_direction else 0
+            np.add.at(folded[qnote], (direction, pairs[:, 0] % pcs, pairs[:, 1] % pcs), weights)
+        return folded if octave_direction else folded[:, 0]
+
     def _adjust_transitions(self, trans_per_qnote: np.ndarray):
         for qnote, count in enumerate(trans_per_qnote):
             for t in self.transitions[qnote]:
@@ -231,6 +456,10 @@ class TonnetzQuarterTrack(Tonnetz):
                 self.note_number_transitions[qnote][t] /= count
 
 
+    @overrides
+    def _drawn_coords(self):
+        return set(c for qtrans in self.transitions for t in qtrans for c in t) or self.lattice.region(2)
+
     @overrides
     def draw(self, draw_edges=False, edge_width_adjust=WIDTH_ADJUST, ax=None, draw_quarters=True):
         Tonnetz.draw(self, draw_edges=draw_edges, ax=ax)
@@ -255,25 +484,27 @@ class TonnetzQuarterTrack(Tonnetz):
                                    width=weights, edge_color=colors[qnote], ax=ax)
 
 
-    def get_weighted_graphs(self) -> list:
+    def get_weighted_graphs(self, nodes: Optional[List[Coord]] = None) -> list:
         '''
-        return four graphs for the four transitions
+        return four graphs for the four transitions, over nodes in order (see shared_nodes)
         '''
+        if nodes is None:
+            nodes = shared_nodes([self])
         graphs = []
         for trans in self.transitions:
             # tempG = nx.DiGraph()
             tempG = nx.Graph()
-            tempG.add_nodes_from(self.G.nodes)
+            tempG.add_nodes_from(nodes)
             tempG.add_weighted_edges_from([(n0, n1, w) for (n0, n1), w in trans.items()])
             graphs.append(tempG)
         return graphs
 
-    def get_matrices(self, matrix_type: MatrixType) -> list:
+    def get_matrices(self, matrix_type: MatrixType, nodes: Optional[List[Coord]] = None) -> list:
         '''
         Return the matrix of each quarter transition in self.transitions
         '''
         matirces = []
-        graphs = self.get_weighted_graphs()
+        graphs = self.get_weighted_graphs(nodes)
         for g in graphs:
             if matrix_type == MatrixType.ADJACENCY:
                 matirces.append(nx.adjacency_matrix(g).todense())
@@ -300,3 +531,13 @@ class TonnetzQuarterTrack(Tonnetz):
             elif centrality_type == CentralityType.EIGENVECTOR:
                 centralities.append(nx.eigenvector_centrality(g, max_iter=300, weight='weight'))
         return centralities    
+
+
+def shared_nodes(tracks: List[TonnetzQuarterTrack]) -> List[Coord]:
+    '''
+    Ordered node set for comparing the matrices of tracks: the whole finite lattice, or in analytic mode the union of
+    the coordinates the tracks use (unused nodes are isolated and add nothing to Laplacian dot products or norms)
+    '''
+    if all(track.lattice is None for track in tracks):
+        return list(tracks[0].G.nodes)
+    return sorted(set(c for track in tracks for c in track._drawn_coords()))